@@ -9,11 +9,13 @@ loglevel = 'info'
 
 proc_name = 'nagato-api'
 
-# More than one worker ruins the caching done by the API
-# In order to solve this, we should use an external service like Redis
-# but this would probably be overkill
-threads = 1
-workers = 1
+# More than one worker requires the `sqlite` backend for the request cache (`requests.cache.backend`),
+# otherwise each worker has its own cache. Note that downloads are tracked by the worker that
+# started them, so the download states can only be retrieved reliably with a single worker.
+# Several threads use the gthread worker, which is required by the event streams since each open
+# stream holds a thread (the API refuses to open more streams than the number of threads minus one).
+threads = int(os.getenv('NAGATO_API_THREADS')) if 'NAGATO_API_THREADS' in os.environ else 8
+workers = int(os.getenv('NAGATO_API_WORKERS')) if 'NAGATO_API_WORKERS' in os.environ else 1
 
 nagato_host = os.getenv('NAGATO_API_HOST') if 'NAGATO_API_HOST' in os.environ else '0.0.0.0'
 nagato_port = os.getenv('NAGATO_API_PORT') if 'NAGATO_API_PORT' in os.environ else '8090'
@@ -6,14 +6,39 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(me
 
 from nagato.downloaders.base import BaseDownloader
 from nagato.downloaders import listSites, siteForURL, downloaderForURL, downloaderForSite
-from nagato.utils import errors, params, threads, database
+from nagato.utils import errors, params, threads, database, covers, config
+from nagato.utils.responses import jsonResponse
+from nagato.utils.request import getCacheStats
 
+import os
 import json
+import time
+import queue
 import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, Response, request
 
 app = Flask('nagato-api')
 
+# Interval in seconds between two comments sent on an idle event stream
+_stream_keepalive = 15
+
+# Streams are closed after this time, so that clients reconnect instead of holding a thread forever
+_stream_lifetime = config.getApiConf('responses.stream.lifetime')
+
+if _stream_lifetime <= 0 :
+	raise errors.ApiConfigurationError(f"The lifetime of the event streams must be positive, but was set to {_stream_lifetime} seconds")
+
+# Each open stream holds a thread of the process, one of them is kept for the other requests
+_stream_max = int(os.getenv('NAGATO_API_THREADS', 8)) - 1
+_stream_count = 0
+_stream_lock = threading.Lock()
+
+# Default and maximum number of downloads listed at once
+_history_page_size = 100
+_history_page_maxsize = 1000
+
 errors.setHandlers(app)
 
 
@@ -29,6 +54,10 @@ def getVersion() :
 def getSites() :
 	return Response(json.dumps(listSites()), 200, content_type='application/json')
 
+@app.route('/api/cache/stats', methods=['GET'])
+def getCacheStatistics() :
+	return Response(json.dumps(getCacheStats()), 200, content_type='application/json')
+
 
 @app.route('/api/manga/id', methods=['GET'])
 def getMangaId() :
@@ -76,7 +105,7 @@ def getMangaInfo(dl: BaseDownloader, manga_id) :
 	res = dl.getMangaInfo(manga_id)
 	if 'includeFav' in request.args and request.args['includeFav'] == 'true' :
 		res['favourite'] = dl.isMangaStarred(manga_id)
-	return Response(json.dumps(res), 200, content_type='application/json')
+	return jsonResponse(res)
 
 
 @app.route('/api/chapter/info', methods=['GET'])
@@ -88,15 +117,83 @@ def getChapterInfo(dl: BaseDownloader, chapter_id) :
 	return Response(json.dumps(res), 200, content_type='application/json')
 
 
+def _batchInfo(data: dict, getId, resolve) -> dict :
+	# The sites are resolved concurrently, each downloader limiting the number of its items resolved at the same time.
+	# Any error is only reported for the items it concerns, the URLs that could not be resolved being reported by URL
+	def toError(e: Exception) -> dict :
+		return {'error': str(e), 'code': errors.getStatus(e)}
+	def resolveSite(site, refs) :
+		try :
+			dl = downloaderForSite(site)
+		except errors.ApiNotFoundError as e :
+			res = {item_id: toError(e) for item_id in refs['ids']}
+			res.update({url: toError(errors.ApiNotFoundError(f"No downloader found for URL \"{url}\"")) for url in refs['urls']})
+			return res
+		failures = {}
+		ids = dict.fromkeys(refs['ids'])
+		for url in refs['urls'] :
+			try :
+				ids[getId(dl, url)] = None
+			except Exception as e :
+				failures[url] = e
+		try :
+			res = resolve(dl, list(ids), failures)
+		except Exception as e :
+			res = {}
+			failures.update({item_id: e for item_id in ids if item_id not in failures})
+		res.update({item: toError(e) for item, e in failures.items()})
+		return res
+	with ThreadPoolExecutor(max_workers=max(1, len(data)), thread_name_prefix='nagato_batch') as executor :
+		return dict(zip(data.keys(), executor.map(resolveSite, data.keys(), data.values())))
+
+@app.route('/api/mangas/info', methods=['POST'])
+@params.siteRefsFromContent
+def postMangasInfo(data: dict) :
+	include_fav = 'includeFav' in request.args and request.args['includeFav'] == 'true'
+	def resolve(dl: BaseDownloader, manga_ids, failures) :
+		res = dl.getMangasInfo(manga_ids, failures)
+		if include_fav :
+			starred = set(dl.getStarredMangas())
+			for manga_id, info in res.items() :
+				info['favourite'] = manga_id in starred
+		return res
+	return jsonResponse(_batchInfo(data, lambda dl, url : dl.getMangaId(url), resolve))
+
+@app.route('/api/chapters/info', methods=['POST'])
+@params.siteRefsFromContent
+def postChaptersInfo(data: dict) :
+	include_mark = 'includeMark' in request.args and request.args['includeMark'] == 'true'
+	def resolve(dl: BaseDownloader, chapter_ids, failures) :
+		res = dl.getChaptersInfo(chapter_ids, failures)
+		if include_mark :
+			marks = dl.getChapterMarks(list(res.keys()))
+			for chapter_id, info in res.items() :
+				info['mark'] = marks[chapter_id]
+		return res
+	return jsonResponse(_batchInfo(data, lambda dl, url : dl.getChapterId(url), resolve))
+
+
 @app.route('/api/manga/cover', methods=['GET'])
 @params.mangaFromArgs
 def getMangaCover(dl: BaseDownloader, manga_id) :
-	res = dl.getCover(manga_id)
+	width = None
+	if 'width' in request.args :
+		width = request.args['width']
+		if not width.isdigit() or int(width) == 0 :
+			raise errors.ApiFormatError(f"The width of the cover must be a positive integer, got {width}")
+		width = int(width)
+	res, etag = covers.getCover(dl, manga_id, width)
 	mime_type = params.imageMimeType(res)
 	if 'base64' in request.args and request.args.get('base64') == 'true' :
 		b64 = base64.b64encode(res)
-		return Response(b64, 200, content_type='text/plain', headers={'Original-Content-Type': mime_type})
-	return Response(res, 200, content_type=mime_type)
+		response = Response(b64, 200, content_type='text/plain', headers={'Original-Content-Type': mime_type})
+		etag = f"{etag}-base64"
+	else :
+		response = Response(res, 200, content_type=mime_type)
+	response.set_etag(etag)
+	response.cache_control.public = True
+	response.cache_control.max_age = covers.getMaxAge()
+	return response.make_conditional(request)
 
 
 @app.route('/api/manga/chapters', methods=['GET'])
@@ -107,7 +204,7 @@ def getMangaChapters(dl: BaseDownloader, manga_id) :
 		marks = dl.getChaptersMarksForManga(manga_id)
 		for chapter_id, chapter_info in res.items() :
 			chapter_info['mark'] = marks[chapter_id] if chapter_id in marks else None
-	return Response(json.dumps(res), 200, content_type='application/json')
+	return jsonResponse(res)
 
 
 @app.route('/api/download/chapter', methods=['POST'])
@@ -139,9 +236,87 @@ def getDownloadStates() :
 		ids = request.args.getlist('ids')
 	elif 'ids[]' in request.args :
 		ids = request.args.getlist('ids[]')
-	# Note : if `None`, just retrieve all the current downloads
-	res = threads.getAllDownloadStates(ids)
-	return Response(json.dumps(res), 200, content_type='application/json')
+	if ids is not None :
+		res = threads.getAllDownloadStates(ids)
+		return Response(json.dumps(res), 200, content_type='application/json')
+	# Without ids, the downloads are listed by pages from the most recent
+	limit = _history_page_size
+	if 'limit' in request.args :
+		limit = request.args['limit']
+		if not limit.isdigit() or not 0 < int(limit) <= _history_page_maxsize :
+			raise errors.ApiFormatError(f"The limit must be an integer between 1 and {_history_page_maxsize}, got {limit}")
+		limit = int(limit)
+	statuses = None
+	if 'status' in request.args :
+		statuses = request.args.getlist('status')
+	elif 'status[]' in request.args :
+		statuses = request.args.getlist('status[]')
+	if statuses is not None :
+		for status in statuses :
+			if status not in threads.DownloadState.__members__ :
+				raise errors.ApiFormatError(f"Unknown download status {status}")
+	times = {}
+	for arg in ['since', 'until'] :
+		if arg in request.args :
+			if not request.args[arg].isdigit() :
+				raise errors.ApiFormatError(f"The {arg} parameter must be a timestamp in milliseconds, got {request.args[arg]}")
+			times[arg] = int(request.args[arg])
+	res, next_cursor = threads.listDownloadStates(limit, request.args.get('site'), statuses, 
+			times.get('since'), times.get('until'), request.args.get('cursor'))
+	headers = {'Next-Cursor': next_cursor} if next_cursor is not None else {}
+	return Response(json.dumps(res), 200, content_type='application/json', headers=headers)
+
+@app.route('/api/dl_states/stream', methods=['GET'])
+def getDownloadStatesStream() :
+	ids = None
+	if 'ids' in request.args :
+		ids = set(request.args.getlist('ids'))
+	elif 'ids[]' in request.args :
+		ids = set(request.args.getlist('ids[]'))
+	global _stream_count
+	with _stream_lock :
+		if _stream_count >= _stream_max :
+			return Response('Too many open event streams, NAGATO_API_THREADS should be increased', 503, headers={'Retry-After': str(_stream_keepalive)})
+		_stream_count += 1
+	def close() :
+		global _stream_count
+		with _stream_lock :
+			_stream_count -= 1
+	def stream() :
+		end = time.monotonic() + _stream_lifetime
+		# Subscribed before reading the current states so that no transition is missed
+		events = threads.subscribe()
+		try :
+			if ids is None :
+				initial = threads.getActiveDownloadStates()
+			else :
+				initial = {dl_id: state for dl_id, state in threads.getAllDownloadStates(list(ids)).items() if state is not None}
+			pending = None if ids is None else set(ids)
+			for dl_id, state in initial.items() :
+				yield f"event: state\ndata: {json.dumps({'id': dl_id, **state})}\n\n"
+				if pending is not None and threads.DownloadState[state['status']].isFinal() :
+					pending.discard(dl_id)
+			while pending is None or len(pending) > 0 :
+				remaining = end - time.monotonic()
+				if remaining <= 0 :
+					break
+				try :
+					event_type, data = events.get(timeout=min(_stream_keepalive, remaining))
+				except queue.Empty :
+					# Also allows to notice that the client is gone
+					yield ': keep-alive\n\n'
+					continue
+				if ids is not None and data['id'] not in ids :
+					continue
+				yield f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+				if pending is not None and event_type == 'state' and threads.DownloadState[data['status']].isFinal() :
+					pending.discard(data['id'])
+		finally :
+			threads.unsubscribe(events)
+	response = Response(stream(), 200, content_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+	# Called even if the stream is never iterated
+	response.call_on_close(close)
+	return response
 
 @app.route('/api/cancel/download/<dl_id>', methods=['POST'])
 def postCancelDownload(dl_id) :
@@ -239,8 +414,8 @@ def getMangaFavs() :
 		for site, manga_ids in res.items() :
 			if site in sites :
 				dl = downloaderForSite(site)
-				res[site] = {manga_id: dl.getMangaInfo(manga_id) for manga_id in manga_ids}
-	return Response(json.dumps(res), 200, content_type='application/json')
+				res[site] = dl.getMangasInfo(manga_ids)
+	return jsonResponse(res)
 
 @app.route('/api/manga/marked', methods=['GET'])
 @params.mangaFromArgs
@@ -256,15 +431,14 @@ def postDownloadNewChapters(dl: BaseDownloader, manga_id) :
 
 @app.route('/api/download/allnew', methods=['POST'])
 def postDownloadAllNewChapters() :
+	site = request.args['site'] if 'site' in request.args else None
+	if site is not None :
+		downloaderForSite(site)
 	with database.getConnection() as con :
 		cur = con.cursor()
-		if 'site' in request.args :
-			dl = downloaderForSite(request.args['site'])
-			res = dl.downloadAllNew(cur)
-		else :
-			res = []
-			starred = database.SqlMangaEntry.getAllStarred(cur).keys()
-			for site in starred :
-				dl = downloaderForSite(site)
-				res.extend(dl.downloadAllNew(cur))
+		starred = database.SqlMangaEntry.getStarredWithMarks(cur, site)
+	# The lists of chapters are retrieved once the connection is released
+	with ThreadPoolExecutor(max_workers=max(1, len(starred)), thread_name_prefix='nagato_allnew') as executor :
+		results = executor.map(lambda e : downloaderForSite(e[0]).downloadAllNew(e[1]), starred.items())
+		res = [dl_id for site_res in results for dl_id in site_res]
 	return Response(json.dumps(res), 202, content_type='application/json')
@@ -2,19 +2,27 @@
 from nagato.utils.request import RequesterBuilder
 from nagato.utils.errors import ApiConfigurationError
 from nagato.utils.sanitise import sanitiseNodeName
-from nagato.utils.compression import Archiver, getArchiverForMethod
-from nagato.utils.threads import ChapterDownload
+from nagato.utils.compression import Archiver, getArchiverForMethod, purgeCheckpoints, purgePartFiles
+from nagato.utils.threads import ChapterDownload, setSiteLimit, prefetchChapters
 from nagato.utils.database import getConnection, SqlChapterEntry, SqlMangaEntry, ChapterMark
+from nagato.utils.metadata import persisted
 
 import os
+import asyncio
+import hashlib
 import logging
 from string import Template
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
 
 class BaseDownloader :
 
+	# Number of entries given at most to a single call to `prefetchChapters` or `prefetchMangas`
+	_prefetch_size = 100
+
 	def __init__(self, site: str, config) :
 		self._site = site
 		self._archiver_class = getArchiverForMethod(config['chapters.method'])
@@ -37,6 +45,25 @@ class BaseDownloader :
 		else :
 			self.getDestinationFolder = self.destFolderMixed
 		self._pagedelay = config['chapters.pagedelay']
+		self._pageworkers = config['chapters.pageworkers']
+		if self._pageworkers < 1 :
+			raise ApiConfigurationError(f"The number of page workers must be at least 1, but was set to {self._pageworkers} in class {type(self).__name__}")
+		self._mangaworkers = config['mangas.workers']
+		if self._mangaworkers < 1 :
+			raise ApiConfigurationError(f"The number of manga workers must be at least 1, but was set to {self._mangaworkers} in class {type(self).__name__}")
+		self._ratelimit = (config['requests.rate'], config['requests.burst'])
+		if self._ratelimit[0] < 0 or self._ratelimit[1] < 1 :
+			raise ApiConfigurationError(f"Invalid rate limit of {self._ratelimit[0]} requests per second with bursts of {self._ratelimit[1]} requests in class {type(self).__name__}")
+		setSiteLimit(site, config['chapters.workers'])
+		self._partial_maxage = config['chapters.partial.maxage']
+		if self._partial_maxage < 0 :
+			raise ApiConfigurationError(f"The age of the saved pages must be positive, but was set to {self._partial_maxage} seconds in class {type(self).__name__}")
+		purgeCheckpoints(self._getPartialSiteFolder(), self._partial_maxage)
+		purgePartFiles(self._destination, self._partial_maxage)
+		# The metadata is stored in the database and revalidated once stale
+		self.getMangaInfo = persisted(site, 'manga', config['metadata.ttl.manga'], self.getMangaInfo)
+		self.getChapterInfo = persisted(site, 'chapter', config['metadata.ttl.chapter'], self.getChapterInfo)
+		self.getChapters = persisted(site, 'chapters', config['metadata.ttl.chapters'], self.getChapters)
 	
 	
 	def getSite(self) -> str :
@@ -56,18 +83,118 @@ class BaseDownloader :
 	
 	def getCover(self, manga_id) :
 		raise NotImplementedError
+	
+	def getCoverUrl(self, manga_id) -> "tuple[str, RequesterBuilder]" :
+		"""
+		Retrieves the URL of the cover of a manga (or None if it has no cover) along with the builder 
+		of the requester used to download it, which allows the cover to be revalidated when it is cached.
+		Raises NotImplementedError if the cover is not available at a fixed URL
+		"""
+		raise NotImplementedError
 
 	def getChapters(self, manga_id) :
 		raise NotImplementedError
 	 
 	def downloadChapters(self, ids, register_mark = False) -> "list[str]" :
-		return [ChapterDownload(self, chapter_id, register_mark).submit() for chapter_id in ids]
+		res = []
+		ids = list(ids)
+		# The information on the chapters stored in the database doesn't need to be requested
+		stale = set(self.getChapterInfo.stale(ids))
+		for batch in self._prefetchBatches(ids) :
+			to_prefetch = [chapter_id for chapter_id in batch if chapter_id in stale]
+			prefetch = prefetchChapters(self, to_prefetch) if len(to_prefetch) > 1 else None
+			res.extend([
+				ChapterDownload(self, chapter_id, register_mark).submit(prefetch if chapter_id in stale else None) 
+				for chapter_id in batch
+			])
+		return res
 	
 	def downloadChapter(self, chapter_id, archiver: Archiver) :
 		images, builder = self.getChapterUrls(chapter_id)
+		self.downloadPages(images, builder, archiver)
+	
+	def getCheckpointKey(self, images: "list[str]") -> str :
+		"""
+		Identifies the pages of a chapter, so that the pages saved by a previous download of the chapter
+		are only reused if they are the same. Hashes the URLs by default, downloaders whose URLs 
+		contain parts that change between two requests (servers, tokens, ...) should override it
+		"""
+		return hashlib.sha1('\n'.join(images).encode()).hexdigest()
+
+	def downloadPages(self, images: "list[str]", builder: RequesterBuilder, archiver: Archiver) :
+		archiver.prepareCheckpoints(self.getCheckpointKey(images))
 		with builder.session() as requester :
-			for image_url in images :
-				archiver.addFile(requester.requestBinary(image_url, delay=self._pagedelay))
+			def fetch(index, image_url) :
+				# Pages saved by a previous attempt are not requested again
+				page = archiver.restorePage(index)
+				if page is None :
+					page = requester.requestBinary(image_url, delay=self._pagedelay)
+					archiver.checkpointPage(index, page)
+				return page
+			if self._pageworkers == 1 :
+				for index, image_url in enumerate(images) :
+					archiver.addFile(fetch(index, image_url))
+				return
+			with ThreadPoolExecutor(max_workers=self._pageworkers, thread_name_prefix='nagato_page') as executor :
+				# Sliding window of at most `_pageworkers` pages, consumed in order so that the numbering is preserved
+				pending = deque()
+				urls = enumerate(images)
+				try :
+					for index, image_url in urls :
+						pending.append(executor.submit(fetch, index, image_url))
+						if len(pending) >= self._pageworkers :
+							break
+					while len(pending) > 0 :
+						page = pending.popleft().result()
+						next_page = next(urls, None)
+						if next_page is not None :
+							pending.append(executor.submit(fetch, *next_page))
+						archiver.addFile(page)
+				except BaseException :
+					for future in pending :
+						future.cancel()
+					raise
+	
+	async def downloadChapterAsync(self, chapter_id, archiver: Archiver) :
+		"""
+		Downloads a chapter with the asyncio engine (see `downloads.engine`), the pages being requested
+		on the event loop. A downloader that overrides `downloadChapter` is run in a thread instead,
+		as well as the pages of a builder that has custom handlers
+		"""
+		loop = asyncio.get_running_loop()
+		if type(self).downloadChapter is not BaseDownloader.downloadChapter :
+			await loop.run_in_executor(None, self.downloadChapter, chapter_id, archiver)
+			return
+		images, builder = await loop.run_in_executor(None, self.getChapterUrls, chapter_id)
+		await loop.run_in_executor(None, archiver.prepareCheckpoints, self.getCheckpointKey(images))
+		requester = builder.buildAsync()
+		if requester is None :
+			await loop.run_in_executor(None, self.downloadPages, images, builder, archiver)
+			return
+		async def fetch(index, image_url) :
+			page = await loop.run_in_executor(None, archiver.restorePage, index)
+			if page is None :
+				page = await requester.requestBinary(image_url, delay=self._pagedelay)
+				await loop.run_in_executor(None, archiver.checkpointPage, index, page)
+			return page
+		# Same sliding window as `downloadPages`, with tasks instead of threads
+		pending = deque()
+		urls = enumerate(images)
+		try :
+			for index, image_url in urls :
+				pending.append(asyncio.ensure_future(fetch(index, image_url)))
+				if len(pending) >= self._pageworkers :
+					break
+			while len(pending) > 0 :
+				page = await pending.popleft()
+				next_page = next(urls, None)
+				if next_page is not None :
+					pending.append(asyncio.ensure_future(fetch(*next_page)))
+				await loop.run_in_executor(None, archiver.addFile, page)
+		except BaseException :
+			for task in pending :
+				task.cancel()
+			raise
 	
 	def getChapterUrls(self, chapter_id) -> "tuple[list[str], RequesterBuilder]" :
 		raise NotImplementedError
@@ -75,6 +202,64 @@ class BaseDownloader :
 	def getChapterInfo(self, chapter_id) :
 		raise NotImplementedError
 
+	def prefetchChapters(self, chapter_ids) :
+		"""
+		Retrieves the information on several chapters at once so that the following calls 
+		to `getChapterInfo` for these chapters are faster, does nothing by default
+		"""
+		pass
+
+	def prefetchMangas(self, manga_ids) :
+		"""
+		Retrieves the information on several mangas at once so that the following calls 
+		to `getMangaInfo` for these mangas are faster, does nothing by default
+		"""
+		pass
+
+	def _prefetchBatches(self, ids: "list[str]") :
+		for i in range(0, len(ids), self._prefetch_size) :
+			yield ids[i:i+self._prefetch_size]
+
+	def _getAllInfo(self, ids: "list[str]", fetch, prefetch, errors: dict = None) -> "dict[str,dict]" :
+		# `fetch` is a persisted method, the entries that are not stored or need to be revalidated are prefetched first
+		def get(entry_id) :
+			try :
+				return fetch(entry_id)
+			except Exception as e :
+				if errors is None :
+					raise
+				errors[entry_id] = e
+		ids = list(dict.fromkeys(ids))
+		stale = fetch.stale(ids)
+		stale_ids = set(stale)
+		stored = [entry_id for entry_id in ids if entry_id not in stale_ids]
+		with ThreadPoolExecutor(max_workers=self._mangaworkers, thread_name_prefix='nagato_info') as executor :
+			res = dict(zip(stored, executor.map(get, stored)))
+			for batch in self._prefetchBatches(stale) :
+				if len(batch) > 1 :
+					try :
+						prefetch(batch)
+					except Exception as e :
+						# Not critical, the entries will be requested one by one
+						logger.warning('Could not prefetch %d entries: %s', len(batch), e)
+				res.update(zip(batch, executor.map(get, batch)))
+		return {entry_id: res[entry_id] for entry_id in ids if errors is None or entry_id not in errors}
+
+	def getMangasInfo(self, manga_ids: "list[str]", errors: dict = None) -> "dict[str,dict]" :
+		"""
+		Retrieves the information on several mangas, with at most `mangas.workers` calls to `getMangaInfo` 
+		at the same time. The mangas that are not stored or need to be revalidated are prefetched first.
+		If `errors` is given, the mangas that could not be retrieved are left out of the result 
+		and their exceptions are added to it, instead of being raised
+		"""
+		return self._getAllInfo(manga_ids, self.getMangaInfo, self.prefetchMangas, errors)
+
+	def getChaptersInfo(self, chapter_ids: "list[str]", errors: dict = None) -> "dict[str,dict]" :
+		"""
+		Same as `getMangasInfo` for the information on chapters
+		"""
+		return self._getAllInfo(chapter_ids, self.getChapterInfo, self.prefetchChapters, errors)
+
 	def getArchiver(self, chapter_id) -> Archiver :
 		return self._archiver_class(self, chapter_id)
 
@@ -105,23 +290,50 @@ class BaseDownloader :
 	def destFolderMixed(self, format_info) :
 		return self._destination
 	
+	def _getPartialSiteFolder(self) :
+		return os.path.join(self._destination, '.nagato-partial', sanitiseNodeName(self._site))
+
+	def getPartialFolder(self, chapter_id) :
+		return os.path.join(self._getPartialSiteFolder(), sanitiseNodeName(chapter_id))
+	
 	def getChapterMarks(self, chapter_ids: str) :
-		res = {}
 		with getConnection() as con :
 			cur = con.cursor()
-			for chapter_id in chapter_ids :
-				entry = SqlChapterEntry(self._site, chapter_id, self)
-				mark = entry.getMark(cur)
-				res[chapter_id] = mark.name if mark is not None else None
-		return res
+			marks = SqlChapterEntry.getMarks(cur, self._site, chapter_ids)
+		return {chapter_id: marks[chapter_id].name if chapter_id in marks else None for chapter_id in chapter_ids}
 			
 	def setChapterMarks(self, chapter_ids: "list[str]", mark: ChapterMark) -> bool :
-		res = False
+		if mark is None :
+			with getConnection(write=True) as con :
+				cur = con.cursor()
+				res = SqlChapterEntry.deleteMarks(cur, self._site, chapter_ids)
+				con.commit()
+			return res
 		with getConnection() as con :
 			cur = con.cursor()
-			for chapter_id in chapter_ids :
-				entry = SqlChapterEntry(self._site, chapter_id, self)
-				res = entry.setMark(cur, mark) or res
+			known = SqlChapterEntry.getMangas(cur, self._site, chapter_ids)
+		# Resolved before taking the lock of the writers since this may require HTTP requests
+		chapters = {chapter_id: known[chapter_id] for chapter_id in chapter_ids if chapter_id in known}
+		unknown = [chapter_id for chapter_id in chapter_ids if chapter_id not in known]
+		# The mangas of the chapters whose information is stored in the database are read from it
+		stale = set(self.getChapterInfo.stale(unknown))
+		chapters.update({chapter_id: self.getChapterInfo(chapter_id)['manga'] for chapter_id in unknown if chapter_id not in stale})
+		for batch in self._prefetchBatches([chapter_id for chapter_id in unknown if chapter_id in stale]) :
+			if len(batch) > 1 :
+				try :
+					self.prefetchChapters(batch)
+				except Exception as e :
+					# Not critical, the chapters will be requested one by one
+					logger.warning('Could not prefetch %d chapters: %s', len(batch), e)
+			# The prefetched chapters are usually stored now
+			still_stale = set(self.getChapterInfo.stale(batch))
+			chapters.update({
+				chapter_id: self.getMangaForChapter(chapter_id) if chapter_id in still_stale else self.getChapterInfo(chapter_id)['manga'] 
+				for chapter_id in batch
+			})
+		with getConnection(write=True) as con :
+			cur = con.cursor()
+			res = SqlChapterEntry.setMarks(cur, self._site, chapters, mark)
 			con.commit()
 		return res
 	
@@ -132,7 +344,7 @@ class BaseDownloader :
 			return entry.isStarred(cur)
 
 	def setMangaStar(self, manga_id, star: bool) :
-		with getConnection() as con :
+		with getConnection(write=True) as con :
 			cur = con.cursor()
 			entry = SqlMangaEntry(self._site, manga_id)
 			res = entry.star(cur) if star else entry.unstar(cur)
@@ -154,16 +366,18 @@ class BaseDownloader :
 
 	def downloadUnmarked(self, manga_id: str) -> "list[str]" :
 		marks = self.getChaptersMarksForManga(manga_id)
-		chapters = self.getChapters(manga_id)
+		chapters = self.getChapters.refresh(manga_id)
 		unmarked = [c for c in chapters.keys() if c not in marks]
 		return self.downloadChapters(unmarked, True)
 
-	def downloadAllNew(self, cur) -> "list[str]" :
+	def downloadAllNew(self, mangas: "dict[str,set[str]]") -> "list[str]" :
+		"""
+		Downloads the chapters that are not marked, `mangas` associating the identifiers 
+		of the mangas with the identifiers of their marked chapters
+		"""
+		with ThreadPoolExecutor(max_workers=self._mangaworkers, thread_name_prefix='nagato_feed') as executor :
+			chapters = list(executor.map(self.getChapters.refresh, mangas.keys()))
 		unmarked = []
-		mangas = SqlMangaEntry.getStarredForSite(cur, self._site)
-		for manga_id in mangas :
-			entry = SqlMangaEntry(self._site, manga_id)
-			marks = entry.getChaptersWithTags(cur)
-			chapters = self.getChapters(manga_id)
-			unmarked.extend([c for c in chapters if c not in marks])
-		return self.downloadChapters(unmarked, True)
\ No newline at end of file
+		for marks, manga_chapters in zip(mangas.values(), chapters) :
+			unmarked.extend([c for c in manga_chapters if c not in marks])
+		return self.downloadChapters(unmarked, True)
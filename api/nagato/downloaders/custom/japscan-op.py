@@ -122,6 +122,7 @@ class JapscanOnePieceDownloader(BaseDownloader) :
 		super().__init__(site, config)
 		self._builder = RequesterBuilder.get()
 		self._builder.setHeader('User-Agent', config['requests.user-agent'])
+		self._builder.setRateLimit(*self._ratelimit)
 		self._requester = self._builder.build()
 
 	def getChapterId(self, url: str) -> str :
@@ -178,10 +179,14 @@ class JapscanOnePieceDownloader(BaseDownloader) :
 			'status': 'ongoing'
 		}
 	
-	def getCover(self, manga_id: str) -> bytes :
+	def getCoverUrl(self, manga_id: str) -> "tuple[str, RequesterBuilder]" :
 		if(manga_id != MANGA_ID) :
 			raise ApiQueryError(f"Manga {manga_id} is not supported by the Japscan One Piece downloader")
-		return self._requester.requestBinary('https://s4.anilist.co/file/anilistcdn/media/manga/cover/large/bx30013-oT7YguhEK1TE.jpg')
+		return 'https://s4.anilist.co/file/anilistcdn/media/manga/cover/large/bx30013-oT7YguhEK1TE.jpg', self._builder
+
+	def getCover(self, manga_id: str) -> bytes :
+		url, _ = self.getCoverUrl(manga_id)
+		return self._requester.requestBinary(url)
 	
 	def _getChapterList(self) :
 		return self._requester.requestSoup(MANGA_URL, chapters_mapper) 
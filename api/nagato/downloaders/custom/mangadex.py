@@ -2,8 +2,11 @@ from nagato.downloaders import custom
 from nagato.downloaders.base import BaseDownloader
 from nagato.utils.errors import ApiUrlError, ApiNotFoundError
 from nagato.utils.request import RequesterBuilder
+from nagato.utils.database import getConnection, SqlFeedEntry
+from nagato.utils.metadata import persisted
 
 import re
+import time
 from requests import Response
 from datetime import datetime, timezone
 
@@ -13,17 +16,29 @@ API_MANGA_URL = f"{API_URL}/manga"
 API_CHAPTER_URL = f"{API_URL}/chapter"
 API_ATHOME_URL = f"{API_URL}/at-home/server"
 
+# Maximum number of results in a page of the list endpoints
+API_LIST_LIMIT = 100
+API_CONTENT_RATINGS = ['safe', 'suggestive', 'erotica', 'pornographic']
+
 manga_page_reg = re.compile(r'https://mangadex\.org/title/([a-z0-9\-]+)/.*')
 chapter_page_reg = re.compile(r'https://mangadex\.org/chapter/([a-z0-9\-]+)(?:/[0-9]+)?')
 
 
 @custom.register(site='mangadex.org')
 class MangadexDownloader(BaseDownloader) :
+
+	_prefetch_size = API_LIST_LIMIT
 	
 	def __init__(self, site: str, config) :
 		super().__init__(site, config)
 		self._lang = config['language.filter']
+		self._incremental = config['feed.incremental']
+		self._resync = config['feed.resync']
+		if self._incremental :
+			# The feeds already store the lists of chapters, storing them a second time would only return outdated ones
+			self.getChapters = persisted(site, 'chapters', 0, self.getChapters.__wrapped__)
 		self._builder = RequesterBuilder.get()
+		self._builder.setRateLimit(*self._ratelimit)
 		self._requester = self._builder.build()
 
 	def getChapterId(self, url) :
@@ -47,8 +62,11 @@ class MangadexDownloader(BaseDownloader) :
 	def _findRelationships(self, relationships, type) :
 		return {elt['id']: elt['attributes'] for elt in relationships if elt['type'] == type}
 
+	def _chapterUrl(self, chapter_id) :
+		return f"{API_CHAPTER_URL}/{chapter_id}?includes[]=scanlation_group"
+
 	def getMangaForChapter(self, chapter_id) :
-		data = self._requester.requestJson(f"{API_CHAPTER_URL}/{chapter_id}")['data']
+		data = self._requester.requestJson(self._chapterUrl(chapter_id))['data']
 		found, res = self._findRelationshipId(data['relationships'], 'manga')
 		if found :
 			return res
@@ -64,8 +82,13 @@ class MangadexDownloader(BaseDownloader) :
 		except ApiUrlError or ApiNotFoundError :
 			raise ApiUrlError(f"URL {url} does not link to any manga nor chapter on the Mangadex website")
 
+	def _mangaUrl(self, manga_id) :
+		return f"{API_MANGA_URL}/{manga_id}?includes[]=author&includes[]=artist"
+
 	def getMangaInfo(self, manga_id) :
-		data = self._requester.requestJson(f"{API_MANGA_URL}/{manga_id}?includes[]=author&includes[]=artist")['data']
+		return self._formatManga(self._requester.requestJson(self._mangaUrl(manga_id))['data'])
+
+	def _formatManga(self, data) :
 		attributes = data['attributes']
 		data_title = attributes['title'].values()
 		title = next(iter(data_title)) if len(data_title) > 0 else 'Untitled'
@@ -84,7 +107,7 @@ class MangadexDownloader(BaseDownloader) :
 		for t in attributes['tags'] :
 			(genres if t['attributes']['group'] == 'genre' else tags).append(t['attributes']['name']['en'])
 		return {
-			'id': manga_id,
+			'id': data['id'],
 			'site': self._site,
 			'title': title,
 			'alt_titles': attributes['altTitles'],
@@ -104,13 +127,19 @@ class MangadexDownloader(BaseDownloader) :
 			'status': attributes['status']
 		}
 	
-	def getCover(self, manga_id) -> bytes:
+	def getCoverUrl(self, manga_id) -> "tuple[str, RequesterBuilder]" :
 		data = self._requester.requestJson(f"{API_MANGA_URL}/{manga_id}?includes[]=cover_art")['data']
 		found, _, attributes = self._findRelationshipAttributes(data['relationships'], 'cover_art')
 		if not found :
-			return None
+			return None, self._builder
 		cover_file = attributes['fileName']
-		return self._requester.requestBinary(f"{CDN_URL}/covers/{manga_id}/{cover_file}")
+		return f"{CDN_URL}/covers/{manga_id}/{cover_file}", self._builder
+
+	def getCover(self, manga_id) -> bytes:
+		url, _ = self.getCoverUrl(manga_id)
+		if url is None :
+			return None
+		return self._requester.requestBinary(url)
 
 	def _formatChapter(self, chapter_data) :
 		attributes = chapter_data['attributes']
@@ -148,38 +177,113 @@ class MangadexDownloader(BaseDownloader) :
 			}
 		}
 	
-	def _chaptersFromApi(self, manga_id) :
-		first_url = f"{API_MANGA_URL}/{manga_id}/feed?translatedLanguage[]={self._lang}&includes[]=scanlation_group&offset=0"
+	def _formatCursor(self, updated_at: str) -> str :
+		# Format expected by the `updatedAtSince` parameter, in UTC
+		dts = updated_at[:-3] + updated_at[-2:]
+		dt = datetime.strptime(dts, '%Y-%m-%dT%H:%M:%S%z')
+		return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+	def _feedUrl(self, manga_id, offset: int, since: str = None) :
+		url = f"{API_MANGA_URL}/{manga_id}/feed?translatedLanguage[]={self._lang}&includes[]=scanlation_group&order[updatedAt]=asc&offset={offset}"
+		if since is not None :
+			url = f"{url}&updatedAtSince={since}"
+		return url
+	
+	def _chaptersFromApi(self, manga_id, since: str = None) :
+		"""
+		Creates an agregator that retrieves the chapters updated since a date (or all the chapters), 
+		along with the cursor for the next synchronisation (date of the latest update)
+		"""
+		first_url = self._feedUrl(manga_id, 0, since)
 		def agregator(response: Response, prev_res, state: dict) -> tuple :
 			data = response.json()
 			if prev_res is None :
-				res = {}
+				res, cursor = {}, since
 				state['limit'] = data['limit']
 				state['total'] = data['total']
 				state['nb_req'] = 1
 			else :
 				state['nb_req'] += 1
-				res = prev_res
+				res, cursor = prev_res
 			for chapter_data in data['data'] :
 				chapter_id, chapter = self._formatChapter(chapter_data)
 				res[chapter_id] = chapter
-			next_url = None
-			if state['nb_req'] * state['limit'] < state['total'] :
-				next_url = f"{API_MANGA_URL}/{manga_id}/feed?translatedLanguage[]={self._lang}&includes[]=scanlation_group&offset={state['nb_req'] * state['limit']}"
-			return res, next_url
+				updated = self._formatCursor(chapter_data['attributes']['updatedAt'])
+				if cursor is None or updated > cursor :
+					cursor = updated
+			next_urls = None
+			if state['nb_req'] == 1 :
+				# The total is known from the first page, so the other pages are requested concurrently
+				next_urls = [self._feedUrl(manga_id, offset, since) for offset in range(state['limit'], state['total'], state['limit'])]
+			return (res, cursor), next_urls
 		return first_url, agregator
 
 	def getChapters(self, manga_id) :
-		url, agregator = self._chaptersFromApi(manga_id)
-		return self._requester.requestAgregate(url, agregator)
+		if not self._incremental :
+			url, agregator = self._chaptersFromApi(manga_id)
+			return self._requester.requestAgregate(url, agregator)[0]
+		feed = SqlFeedEntry(self._site, f"{manga_id}/{self._lang}")
+		with getConnection() as con :
+			stored = feed.get(con.cursor())
+		now = int(time.time())
+		# A full synchronisation is still needed from time to time to forget about deleted chapters
+		# Not cached, a cached page would hide the chapters published since it was requested
+		if stored is None or stored['cursor'] is None or now - stored['synced'] >= self._resync :
+			url, agregator = self._chaptersFromApi(manga_id)
+			chapters, cursor = self._requester.requestAgregate(url, agregator, cache=False)
+			synced = now
+		else :
+			url, agregator = self._chaptersFromApi(manga_id, stored['cursor'])
+			new_chapters, cursor = self._requester.requestAgregate(url, agregator, cache=False)
+			chapters = {**stored['chapters'], **new_chapters}
+			# The filter on the date is inclusive, so the latest chapter is always returned again
+			if cursor == stored['cursor'] and chapters == stored['chapters'] :
+				return stored['chapters']
+			synced = stored['synced']
+		with getConnection(write=True) as con :
+			feed.save(con.cursor(), cursor, synced, chapters)
+			con.commit()
+		return chapters
 	
 	def getChapterInfo(self, chapter_id): 
-		data = self._requester.requestJson(f"{API_CHAPTER_URL}/{chapter_id}?includes[]=scanlation_group")['data']
+		return self._formatChapterInfo(self._requester.requestJson(self._chapterUrl(chapter_id))['data'])
+
+	def _formatChapterInfo(self, data) :
 		chapter = self._formatChapter(data)[1]
-		chapter['id'] = chapter_id
+		chapter['id'] = data['id']
 		chapter['manga'] = self._findRelationshipId(data['relationships'], 'manga')[1]
 		return chapter
 	
+	def prefetchChapters(self, chapter_ids) :
+		chapter_ids = list(chapter_ids)
+		ratings = ''.join(f"&contentRating[]={rating}" for rating in API_CONTENT_RATINGS)
+		for i in range(0, len(chapter_ids), API_LIST_LIMIT) :
+			batch = chapter_ids[i:i+API_LIST_LIMIT]
+			ids = ''.join(f"&ids[]={chapter_id}" for chapter_id in batch)
+			data = self._requester.requestJson(f"{API_CHAPTER_URL}?limit={len(batch)}&includes[]=scanlation_group{ratings}{ids}", cache=False)
+			# Stored with the other metadata, and saved as if they were the responses of the requests made by `getChapterInfo`
+			# (used when the metadata is not stored) and by `getMangaForChapter`
+			self.getChapterInfo.store({chapter_data['id']: self._formatChapterInfo(chapter_data) for chapter_data in data['data']})
+			for chapter_data in data['data'] :
+				self._requester.addToCache(self._chapterUrl(chapter_data['id']), {'result': 'ok', 'response': 'entity', 'data': chapter_data})
+	
+	def prefetchMangas(self, manga_ids) :
+		manga_ids = list(manga_ids)
+		ratings = ''.join(f"&contentRating[]={rating}" for rating in API_CONTENT_RATINGS)
+		for i in range(0, len(manga_ids), API_LIST_LIMIT) :
+			batch = manga_ids[i:i+API_LIST_LIMIT]
+			ids = ''.join(f"&ids[]={manga_id}" for manga_id in batch)
+			data = self._requester.requestJson(f"{API_MANGA_URL}?limit={len(batch)}&includes[]=author&includes[]=artist{ratings}{ids}", cache=False)
+			# Stored with the other metadata, and saved as if they were the responses of the requests made by `getMangaInfo`
+			# (used when the metadata is not stored)
+			self.getMangaInfo.store({manga_data['id']: self._formatManga(manga_data) for manga_data in data['data']})
+			for manga_data in data['data'] :
+				self._requester.addToCache(self._mangaUrl(manga_data['id']), {'result': 'ok', 'response': 'entity', 'data': manga_data})
+	
+	def getCheckpointKey(self, images: "list[str]") -> str :
+		# The server of MangaDex@Home changes between two requests, only the hash of the chapter and the names of the pages identify them
+		return super().getCheckpointKey(['/'.join(url.rsplit('/', 2)[-2:]) for url in images])
+
 	def getChapterUrls(self, chapter_id) -> "tuple[list[str], RequesterBuilder]" :
 		data = self._requester.requestJson(f"{API_ATHOME_URL}/{chapter_id}")
 		base_url = data['baseUrl']
@@ -0,0 +1,124 @@
+from nagato.utils.errors import ApiConfigurationError, ApiQueryError
+from nagato.utils.request import Requester, getHostLimiter, retryAfter, retryOnStatus, retryDelay
+from nagato.utils import config
+
+import atexit
+import asyncio
+import logging
+import threading
+
+try :
+	import aiohttp
+except ImportError :
+	aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+_engine = config.getApiConf('downloads.engine')
+_connections = config.getApiConf('downloads.asyncio.connections')
+
+if _engine not in ('threads', 'asyncio') :
+	raise ApiConfigurationError(f"Unknown download engine {_engine}, should be either threads or asyncio")
+
+if _engine == 'asyncio' and aiohttp is None :
+	raise ApiConfigurationError("The asyncio download engine requires the aiohttp module, which is not installed")
+
+if not isinstance(_connections, int) or _connections < 1 :
+	raise ApiConfigurationError(f"The number of connections of the asyncio download engine must be at least 1, but was set to {_connections}")
+
+
+def isEnabled() -> bool :
+	"""
+	Indicates if the chapters are downloaded by the asyncio engine rather than by threads
+	"""
+	return _engine == 'asyncio'
+
+
+_loop: asyncio.AbstractEventLoop = None
+_loop_lock = threading.Lock()
+
+def getLoop() -> asyncio.AbstractEventLoop :
+	"""
+	Retrieves the event loop of the engine, which runs in its own thread once started by the first call
+	"""
+	global _loop
+	with _loop_lock :
+		if _loop is None :
+			_loop = asyncio.new_event_loop()
+			threading.Thread(target=_loop.run_forever, name='nagato_aio', daemon=True).start()
+		return _loop
+
+
+# Only used from the event loop, so it doesn't need a lock
+_session: "aiohttp.ClientSession" = None
+
+def _getSession() -> "aiohttp.ClientSession" :
+	global _session
+	if _session is None :
+		# The connector bounds the number of requests made at the same time by all the downloads
+		_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=_connections))
+	return _session
+
+@atexit.register
+def _closeSession() :
+	if _session is not None :
+		asyncio.run_coroutine_threadsafe(_session.close(), _loop).result(timeout=5)
+
+def _clientTimeout(timeout) -> "aiohttp.ClientTimeout" :
+	if timeout is None :
+		return aiohttp.ClientTimeout(total=None)
+	if isinstance(timeout, tuple) :
+		connect, read = timeout
+	else :
+		connect = read = timeout
+	return aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+
+
+class AsyncRequester :
+	"""
+	Counterpart of `nagato.utils.request.Requester` for the asyncio engine, built with `RequesterBuilder.buildAsync`.
+	Requests are retried and rate limited the same way, but never cached
+	"""
+
+	def __init__(self, verb, headers={}, timeout=None, ratelimit=(0, 1)) :
+		self._verb = verb
+		self._headers = headers
+		self._timeout = _clientTimeout(timeout)
+		self._ratelimit = ratelimit
+
+	async def _handleRequest(self, url, delay=0) -> bytes :
+		if delay > 0 :
+			await asyncio.sleep(delay)
+		limiter = getHostLimiter(url, *self._ratelimit)
+		keep_going = True
+		nb_attempts = 0
+		while keep_going :
+			nb_attempts += 1
+			await limiter.acquireAsync()
+			logger.info(f"Request to \"{url}\"")
+			wait = None
+			try :
+				async with _getSession().request(self._verb, url, headers=self._headers, timeout=self._timeout) as res :
+					if res.ok :
+						return await res.read()
+					logger.warning(f"Request n°{nb_attempts} to {url} failed with return code {res.status} {res.reason}")
+					failure = f"return code {res.status} {res.reason}"
+					keep_going = retryOnStatus(url, res.status, res.reason, nb_attempts)
+					wait = retryAfter(res)
+			except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e :
+				logger.warning(f"Request n°{nb_attempts} to {url} failed with error of type {type(e).__name__}")
+				failure = f"error of type {type(e).__name__}"
+				keep_going = Requester.defaultConnectionErrorHandle(e, nb_attempts)
+			retry = retryDelay(url, nb_attempts, wait) if keep_going else None
+			if retry is None :
+				break
+			duration, overloaded = retry
+			if overloaded :
+				# The host is overloaded, so all the requests to it must wait
+				limiter.pause(duration)
+			else :
+				await asyncio.sleep(duration)
+		raise ApiQueryError(f"Request to {url} failed after {nb_attempts} attempts with {failure}")
+
+	async def requestBinary(self, url, delay=0) -> bytes :
+		return await self._handleRequest(url, delay)
@@ -3,8 +3,12 @@ from nagato.utils import config
 
 import io
 import os
+import time
+import uuid
+import shutil
 import zipfile
 import logging
+import threading
 from lxml import etree
 from PIL import Image
 
@@ -75,6 +79,71 @@ def getArchiverForMethod(method: str) :
 	return _dl_methods[method]
 
 
+# Number of downloads of the process using each partial download area, so that it is only deleted by the last one
+_partial_users: "dict[str,int]" = {}
+_partial_lock = threading.Lock()
+
+def _writeReplace(path: str, content: bytes) :
+	# Written then renamed, so that a file interrupted while being saved is never read.
+	# The temporary name is unique since two processes may write the same file at the same time
+	tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+	try :
+		with open(tmp_path, 'wb') as f :
+			f.write(content)
+		os.replace(tmp_path, path)
+	except BaseException :
+		if os.path.exists(tmp_path) :
+			os.remove(tmp_path)
+		raise
+
+def purgeCheckpoints(folder: str, maxage: int) :
+	'''purgeCheckpoints Deletes the partial download areas that were not modified for some time
+
+	The pages of a chapter that failed are kept until it is downloaded again,
+	which may never happen.
+
+	Args:
+		folder (str): The folder containing the partial download areas of the chapters of a site
+		maxage (int): The age in seconds after which an area is deleted, 0 to keep them all
+	'''
+	if maxage <= 0 or not os.path.isdir(folder) :
+		return
+	limit = time.time() - maxage
+	for entry in os.scandir(folder) :
+		try :
+			if entry.is_dir() and entry.stat().st_mtime < limit :
+				logger.info('Deleting the saved pages of chapter %s', entry.name)
+				shutil.rmtree(entry.path, ignore_errors=True)
+		except FileNotFoundError :
+			pass
+
+def purgePartFiles(folder: str, maxage: int) :
+	'''purgePartFiles Deletes the temporary files of the archives that were not modified for some time
+
+	They are left by a download interrupted by the end of the process.
+
+	Args:
+		folder (str): The destination folder of the chapters
+		maxage (int): The age in seconds after which a temporary file is deleted, 0 to keep them all
+	'''
+	if maxage <= 0 or not os.path.isdir(folder) :
+		return
+	limit = time.time() - maxage
+	folders = [folder]
+	# The chapters are saved either in the destination folder or in the folders of the mangas
+	for entry in os.scandir(folder) :
+		if entry.is_dir(follow_symlinks=False) and entry.name != '.nagato-partial' :
+			folders.append(entry.path)
+	for path in folders :
+		for entry in os.scandir(path) :
+			try :
+				if entry.name.startswith('.nagato-') and entry.name.endswith('.part') and entry.stat().st_mtime < limit :
+					logger.info('Deleting the abandoned temporary file %s', entry.path)
+					os.remove(entry.path)
+			except FileNotFoundError :
+				pass
+
+
 class Archiver :
 	''' Archiver
 	This is a base class that used to save files while they are being downloaded.
@@ -99,6 +168,9 @@ class Archiver :
 		self._npages = self._chapter['pages']
 		self._destination = downloader.getDestinationFolder(self._format)
 		self._filename = sanitiseNodeName(downloader.getFilename(self._format))
+		self._partial = downloader.getPartialFolder(chapter_id)
+		self._checkpoints = False
+		self._listener = None
 		self._cpt = 0
 		self._rawsize = 0
 		self._maxlen = len(str(self._npages))
@@ -129,6 +201,14 @@ class Archiver :
 			return -1
 		return self._cpt / self._npages
 	
+	def setProgressListener(self, listener) :
+		'''setProgressListener Sets a callable notified each time a page is added
+
+		Args:
+			listener (callable): Called with the `Archiver` as its only argument, after the page is processed
+		'''
+		self._listener = listener
+
 	def getRawSize(self) -> int :
 		'''getRawSize Retrieves the total size of files downloaded so far (uncompressed)
 
@@ -160,6 +240,8 @@ class Archiver :
 		self._rawsize += len(file)
 		filename = nameImage(file, self._cpt, self._maxlen)
 		self.processFile(file, filename)
+		if self._listener is not None :
+			self._listener(self)
 	
 	def processFile(self, file: bytes, name: str) :
 		'''processFile Method that processes a file that has been added to the `Archiver`
@@ -177,6 +259,101 @@ class Archiver :
 		'''		
 		raise NotImplementedError
 	
+	def prepareCheckpoints(self, key: str) :
+		'''prepareCheckpoints Enables the partial download area for the pages identified by a key
+
+		Must be called before `checkpointPage` and `restorePage`, which do nothing otherwise.
+		The pages saved by a previous download of the chapter are discarded if they were 
+		saved with another key, typically because the pages of the chapter changed.
+
+		Args:
+			key (str): Identifies the list of pages of the chapter, see `BaseDownloader.getCheckpointKey`
+		'''
+		keypath = os.path.join(self._partial, 'key')
+		with _partial_lock :
+			users = _partial_users.get(self._partial, 0)
+			try :
+				with open(keypath, 'r') as f :
+					saved_key = f.read()
+			except FileNotFoundError :
+				saved_key = None
+			if saved_key == key :
+				logger.info('Resuming download of chapter %s with %d saved pages', self._chapter['id'], len(os.listdir(self._partial)) - 1)
+			elif users > 0 :
+				# Another download of the chapter uses the area, its pages are left alone and these ones are not saved
+				logger.info('Not saving the pages of chapter %s, it is being downloaded with other pages', self._chapter['id'])
+				return
+			else :
+				if os.path.isdir(self._partial) :
+					logger.info('Discarding the saved pages of chapter %s, its pages changed', self._chapter['id'])
+					shutil.rmtree(self._partial, ignore_errors=True)
+				os.makedirs(self._partial, exist_ok=True)
+				_writeReplace(keypath, key.encode())
+			_partial_users[self._partial] = users + 1
+			self._checkpoints = True
+
+	def checkpointPage(self, index: int, file: bytes) :
+		'''checkpointPage Saves a downloaded page in the partial download area
+
+		Pages are saved as soon as they are downloaded, possibly out of order, so that
+		a later download of the same chapter can resume instead of starting over.
+		May be called from several threads at once, but for different pages.
+
+		Args:
+			index (int): The index of the page in the chapter, starting at 0
+			file (bytes): The page as binary data
+		'''
+		if self._checkpoints :
+			try :
+				_writeReplace(os.path.join(self._partial, str(index)), file)
+			except OSError as e :
+				# Saving the page only helps a later download, it must not make this one fail
+				logger.warning('Could not save page %d of chapter %s: %s', index, self._chapter['id'], e)
+
+	def restorePage(self, index: int) :
+		'''restorePage Retrieves a page saved by a previous download of the chapter
+
+		Args:
+			index (int): The index of the page in the chapter, starting at 0
+
+		Returns:
+			bytes: The page as binary data, or None if it was not saved
+		'''
+		if not self._checkpoints :
+			return None
+		try :
+			with open(os.path.join(self._partial, str(index)), 'rb') as f :
+				return f.read()
+		except FileNotFoundError :
+			return None
+
+	def _release(self) -> bool :
+		# Must be called with the lock held, indicates if another download still uses the area
+		if self._checkpoints :
+			self._checkpoints = False
+			users = _partial_users.pop(self._partial) - 1
+			if users > 0 :
+				_partial_users[self._partial] = users
+		return self._partial in _partial_users
+
+	def releaseCheckpoints(self) :
+		'''releaseCheckpoints Stops using the partial download area, keeping the saved pages
+
+		Must be called if the download failed.
+		'''
+		with _partial_lock :
+			self._release()
+
+	def clearCheckpoints(self) :
+		'''clearCheckpoints Deletes the pages saved in the partial download area
+
+		Must be called once the chapter is completely saved. The pages are kept 
+		while another download of the same chapter is using them.
+		'''
+		with _partial_lock :
+			if not self._release() :
+				shutil.rmtree(self._partial, ignore_errors=True)
+	
 	def after(self) :
 		'''after Method exectued at the end of a successful download
 		'''		
@@ -186,10 +363,13 @@ class Archiver :
 		'''__exit__ Method called at the end of a `with ... as ...` block
 
 		Derived classes must override this method to free potential allocated resources.
+		The saved pages are only deleted if the download succeeded.
 		'''
 		if exc_type is not None:
 			# traceback.print_exception(exc_type, exc_value, tb)
+			self.releaseCheckpoints()
 			return False
+		self.clearCheckpoints()
 
 
 @dl_method('files')
@@ -231,25 +411,25 @@ class ZipArchiver(Archiver) :
 	def __init__(self, downloader, chapter_id, ext='zip') :
 		'''__init__ Method used to initialise the object
 
-		Creates a buffer for the zip file.
-
 		Args:
 			downloader (BaseDownloader): The downloader that is downloading files
 			chapter_id (str): The identifier of the chapter being downloaded
 		'''		
 		super().__init__(downloader, chapter_id)
-		self._buffer = io.BytesIO()
 		self._extension = ext
 
 	def __enter__(self) :
 		'''__enter__ Method called at the beginning of a `with ... as ...` block
 
-		Creates a zip object with the previously created buffer.
+		Creates a zip object writing to a temporary file in the destination folder,
+		so that the pages are streamed to the disk instead of being kept in memory.
 
 		Returns:
 			ZipArchiver: the resource that will be closed (`self`)
 		'''
-		self._zipfile = zipfile.ZipFile(self._buffer, 'w')
+		self._partpath = os.path.join(self._destination, f".nagato-{uuid.uuid4().hex}.part")
+		self._partfile = open(self._partpath, 'xb')
+		self._zipfile = zipfile.ZipFile(self._partfile, 'w')
 		return self
 
 	def processFile(self, file: bytes, name: str) :
@@ -261,24 +441,36 @@ class ZipArchiver(Archiver) :
 			file (bytes): A file that has been added to the `Archiver`
 			name (str): The name of the file
 		'''
-		self._zipfile.writestr(name, io.BytesIO(file).getvalue())
+		self._zipfile.writestr(name, file)
 
 	def __exit__(self, exc_type, exc_value, tb):
 		'''__exit__ Method called at the end of a `with ... as ...` block
 
-		Saves the content of the zip file to the disc, then frees the zip object and the buffer.
+		Closes the zip object, then moves the temporary file to its final location
+		and deletes the saved pages if the download succeeded, or deletes the temporary
+		file otherwise.
 		'''
-		self._zipfile.close()
-		if exc_type is not None:
-			# traceback.print_exception(exc_type, exc_value, tb)
-			self._buffer.close()
-			return False
-		if self._npages is not None and self._npages != self._cpt :
-			logger.warning('Expected %d pages, got %d', self._npages, self._cpt)
-		filepath = os.path.join(self._destination, f"{self._filename}.{self._extension}")
-		with open(filepath, 'wb') as f :
-			f.write(self._buffer.getvalue())
-		self._buffer.close()
+		saved = False
+		try :
+			try :
+				self._zipfile.close()
+			finally :
+				self._partfile.close()
+			if exc_type is not None:
+				# traceback.print_exception(exc_type, exc_value, tb)
+				return False
+			if self._npages is not None and self._npages != self._cpt :
+				logger.warning('Expected %d pages, got %d', self._npages, self._cpt)
+			filepath = os.path.join(self._destination, f"{self._filename}.{self._extension}")
+			os.replace(self._partpath, filepath)
+			saved = True
+		finally :
+			# Also when closing the zip object failed, otherwise the temporary file would stay forever
+			if not saved :
+				if os.path.exists(self._partpath) :
+					os.remove(self._partpath)
+				self.releaseCheckpoints()
+		self.clearCheckpoints()
 
 
 @dl_method('cbz')
@@ -0,0 +1,147 @@
+from nagato.utils.errors import ApiConfigurationError, ApiNotFoundError, ApiQueryError
+from nagato.utils.sanitise import sanitiseNodeName
+from nagato.utils import config
+
+import io
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+_covers_path: str = config.getApiConf('covers.path')
+_covers_ttl = config.getApiConf('covers.ttl')
+_covers_widths = sorted(config.getApiConf('covers.widths'))
+
+if not os.path.isabs(_covers_path) :
+	_covers_path = os.path.join(config.API_DIR, _covers_path)
+
+if _covers_ttl < 0 :
+	raise ApiConfigurationError(f"The time to live of the covers must be positive, but was set to {_covers_ttl} seconds")
+
+if any(not isinstance(w, int) or w < 1 for w in _covers_widths) :
+	raise ApiConfigurationError(f"Invalid widths for the resized covers : {_covers_widths}")
+
+
+def getMaxAge() -> int :
+	"""
+	Retrieves the time in seconds for which a cover can be kept by a client without being revalidated
+	"""
+	return _covers_ttl
+
+
+def _coverFolder(site: str, manga_id: str) -> str :
+	return os.path.join(_covers_path, sanitiseNodeName(site), sanitiseNodeName(manga_id))
+
+def _write(path: str, content: bytes) :
+	# Written then renamed, so that a cover is never read while being written.
+	# The temporary name is unique since several requests may refresh the same cover at the same time
+	tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+	try :
+		with open(tmp_path, 'wb') as f :
+			f.write(content)
+		os.replace(tmp_path, path)
+	except BaseException :
+		if os.path.exists(tmp_path) :
+			os.remove(tmp_path)
+		raise
+
+def _read(path: str) -> bytes :
+	with open(path, 'rb') as f :
+		return f.read()
+
+def _readInfo(folder: str) :
+	try :
+		with open(os.path.join(folder, 'info.json'), 'r') as f :
+			return json.load(f)
+	except FileNotFoundError :
+		return None
+
+def _saveInfo(folder: str, info: dict) :
+	_write(os.path.join(folder, 'info.json'), json.dumps(info).encode())
+
+
+def _refresh(dl, manga_id: str, folder: str, info: dict) -> dict :
+	"""
+	Retrieves the cover from the site if it changed, and updates the stored cover
+	"""
+	try :
+		url, builder = dl.getCoverUrl(manga_id)
+	except NotImplementedError :
+		url = None
+	try :
+		if url is None :
+			content, etag, last_modified = dl.getCover(manga_id), None, None
+			if content is None :
+				raise ApiNotFoundError(f"Manga {manga_id} has no cover")
+		elif info is not None and info['url'] == url :
+			content, etag, last_modified = builder.build().requestRevalidate(url, info['etag'], info['last_modified'])
+		else :
+			content, etag, last_modified = builder.build().requestRevalidate(url)
+	except ApiNotFoundError :
+		shutil.rmtree(folder, ignore_errors=True)
+		raise
+	except ApiQueryError :
+		if info is None :
+			raise
+		logger.warning('Could not revalidate the cover of manga %s, using the stored one', manga_id)
+		return info
+	os.makedirs(folder, exist_ok=True)
+	new_info = {'url': url, 'etag': etag, 'last_modified': last_modified, 'fetched': int(time.time())}
+	if content is None :
+		# Not modified
+		new_info['hash'] = info['hash']
+	else :
+		new_info['hash'] = hashlib.sha1(content).hexdigest()
+		if info is None or info['hash'] != new_info['hash'] :
+			_write(os.path.join(folder, 'original'), content)
+			for name in os.listdir(folder) :
+				if name.startswith('w') :
+					os.remove(os.path.join(folder, name))
+	_saveInfo(folder, new_info)
+	return new_info
+
+
+def _resized(folder: str, info: dict, width: int) -> "tuple[bytes,str]" :
+	# Only a few widths are stored, the closest larger one is used
+	target = next((w for w in _covers_widths if w >= width), None)
+	if target is None :
+		return _read(os.path.join(folder, 'original')), info['hash']
+	path = os.path.join(folder, f"w{target}")
+	try :
+		return _read(path), f"{info['hash']}-w{target}"
+	except FileNotFoundError :
+		pass
+	original = _read(os.path.join(folder, 'original'))
+	with Image.open(io.BytesIO(original)) as img :
+		if img.width <= target :
+			content = original
+		else :
+			img_format = img.format
+			img.thumbnail((target, img.height))
+			output = io.BytesIO()
+			img.save(output, format=img_format)
+			content = output.getvalue()
+	_write(path, content)
+	return content, f"{info['hash']}-w{target}"
+
+
+def getCover(dl, manga_id: str, width: int = None) -> "tuple[bytes,str]" :
+	"""
+	Retrieves the cover of a manga from the cache on the disk, after retrieving it from the site
+	if it is not cached yet or revalidating it if it is older than `covers.ttl`.
+	If a width is given, the cover is resized to the closest larger width among `covers.widths`.
+	Returns the cover along with its ETag
+	"""
+	folder = _coverFolder(dl.getSite(), manga_id)
+	info = _readInfo(folder)
+	if info is None or int(time.time()) - info['fetched'] >= _covers_ttl :
+		info = _refresh(dl, manga_id, folder, info)
+	if width is not None :
+		return _resized(folder, info, width)
+	return _read(os.path.join(folder, 'original')), info['hash']
@@ -3,12 +3,14 @@ from enum import Enum
 from nagato.utils import config
 
 import os
+import json
 import sqlite3
 import threading
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Only held by the writers, readers can work concurrently thanks to the WAL journal
 mutex = threading.Lock()
 
 
@@ -16,20 +18,46 @@ __database_path: str = config.getApiConf('database.path')
 if not __database_path.startswith('/') :
 	__database_path = os.path.join(config.API_DIR, __database_path)
 
-class SqlConnection :
+class ConnectionPool :
+	"""
+	Keeps one connection to the database for each thread, opened on first use
+	"""
 
-	def __init__(self, path: str, mutex: threading.Lock) :
+	def __init__(self, path: str) :
 		self._path = path
+		self._local = threading.local()
+
+	def connection(self) -> sqlite3.Connection :
+		# Connections can't be shared with a process forked after their creation
+		if getattr(self._local, 'pid', None) != os.getpid() :
+			con = sqlite3.connect(self._path, timeout=30)
+			con.execute('PRAGMA journal_mode=WAL')
+			con.execute('PRAGMA synchronous=NORMAL')
+			con.execute('PRAGMA temp_store=MEMORY')
+			self._local.con = con
+			self._local.pid = os.getpid()
+		return self._local.con
+
+class SqlConnection :
+
+	def __init__(self, pool: ConnectionPool, mutex: threading.Lock) :
+		self._pool = pool
 		self._mutex = mutex
 	
 	def __enter__(self) -> sqlite3.Connection :
-		self._mutex.acquire()
-		self._con = sqlite3.connect(self._path)
+		if self._mutex is not None :
+			self._mutex.acquire()
+		self._con = self._pool.connection()
 		return self._con
 	
 	def __exit__(self, exc_type, exc_value, tb) :
-		self._con.close()
-		self._mutex.release()
+		try :
+			# The connection is reused, changes that were not committed must not leak to the next user
+			if self._con.in_transaction :
+				self._con.rollback()
+		finally :
+			if self._mutex is not None :
+				self._mutex.release()
 		if exc_type is not None :
 			return False
 
@@ -39,13 +67,31 @@ class ChapterMark(Enum) :
 	IGNORED    = 'I'
 
 
-def getConnection() :
-	return SqlConnection(__database_path, mutex)
+_pool = ConnectionPool(__database_path)
+
+def getConnection(write: bool = False) :
+	"""
+	Provides a connection to the database in a `with ... as ...` block, 
+	`write` must be set if the connection is used to modify the database
+	"""
+	return SqlConnection(_pool, mutex if write else None)
 
 def tableExists(cur: sqlite3.Cursor, table_name: str) -> bool :
 	l = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", [table_name]).fetchall()
 	return len(l) > 0
 
+def indexExists(cur: sqlite3.Cursor, index_name: str) -> bool :
+	l = cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?", [index_name]).fetchall()
+	return len(l) > 0
+
+
+# Maximum number of identifiers in a single `IN (...)` clause, to stay below the limit of variables of SQLite
+_batch_size = 500
+
+def _batches(ids: list) :
+	for i in range(0, len(ids), _batch_size) :
+		yield ids[i:i+_batch_size]
+
 
 class SqlMangaEntry :
 
@@ -87,6 +133,23 @@ class SqlMangaEntry :
 		res = cur.execute("SELECT id FROM mangas WHERE site=?", [site]).fetchall()
 		return [e[0] for e in res]
 
+	def getStarredWithMarks(cur: sqlite3.Cursor, site: str = None) -> "dict[str,dict[str,set[str]]]" :
+		"""
+		Retrieves the marked chapters of all the starred mangas (of a site if specified) in a single query,
+		the result associates each site with its starred mangas, which are associated with the identifiers of their marked chapters
+		"""
+		query = "SELECT m.site, m.id, c.id FROM mangas m LEFT JOIN chapters c ON c.site=m.site and c.manga=m.id"
+		if site is None :
+			l = cur.execute(query).fetchall()
+		else :
+			l = cur.execute(f"{query} WHERE m.site=?", [site]).fetchall()
+		res = {}
+		for e in l :
+			marked = res.setdefault(e[0], {}).setdefault(e[1], set())
+			if e[2] is not None :
+				marked.add(e[2])
+		return res
+
 class SqlChapterEntry :
 	
 	def __init__(self, site: str, chapter_id: str, downloader, manga_id = None) :
@@ -116,16 +179,167 @@ class SqlChapterEntry :
 			return True
 		return False
 
+	def getMarks(cur: sqlite3.Cursor, site: str, chapter_ids: "list[str]") -> "dict[str,ChapterMark]" :
+		res = {}
+		for batch in _batches(list(chapter_ids)) :
+			l = cur.execute(f"SELECT id, mark FROM chapters WHERE site=? and id IN ({','.join('?' * len(batch))})", [site, *batch]).fetchall()
+			res.update({e[0]: ChapterMark(e[1]) for e in l})
+		return res
+	
+	def getMangas(cur: sqlite3.Cursor, site: str, chapter_ids: "list[str]") -> "dict[str,str]" :
+		res = {}
+		for batch in _batches(list(chapter_ids)) :
+			l = cur.execute(f"SELECT id, manga FROM chapters WHERE site=? and id IN ({','.join('?' * len(batch))})", [site, *batch]).fetchall()
+			res.update({e[0]: e[1] for e in l})
+		return res
 
-with getConnection() as con :
+	def setMarks(cur: sqlite3.Cursor, site: str, chapters: "dict[str,str]", mark: ChapterMark) -> bool :
+		"""
+		Marks several chapters at once, `chapters` associating the identifier of each chapter with the identifier of its manga
+		"""
+		cur.executemany(
+			"INSERT INTO chapters VALUES (?, ?, ?, ?) ON CONFLICT (site, id) DO UPDATE SET mark=excluded.mark", 
+			[(site, chapter_id, manga_id, mark.value) for chapter_id, manga_id in chapters.items()]
+		)
+		return len(chapters) > 0
+	
+	def deleteMarks(cur: sqlite3.Cursor, site: str, chapter_ids: "list[str]") -> bool :
+		res = False
+		for batch in _batches(list(chapter_ids)) :
+			c = cur.execute(f"DELETE FROM chapters WHERE site=? and id IN ({','.join('?' * len(batch))})", [site, *batch])
+			res = c.rowcount > 0 or res
+		return res
+
+
+class SqlFeedEntry :
+	"""
+	Chapters of a manga stored locally, along with a cursor used by the downloader to only request the newer chapters
+	"""
+
+	def __init__(self, site: str, feed_id: str) :
+		self._site = site
+		self._id = feed_id
+	
+	def get(self, cur: sqlite3.Cursor) -> dict :
+		l = cur.execute("SELECT cursor, synced, chapters FROM feeds WHERE site=? and id=?", [self._site, self._id]).fetchall()
+		if len(l) == 0 :
+			return None
+		return {
+			'cursor': l[0][0],
+			'synced': l[0][1],
+			'chapters': json.loads(l[0][2])
+		}
+	
+	def save(self, cur: sqlite3.Cursor, cursor: str, synced: int, chapters: dict) :
+		cur.execute("INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?, ?)", [self._site, self._id, cursor, synced, json.dumps(chapters)])
+
+
+class SqlMetadataEntry :
+	"""
+	Copy of some metadata retrieved by a downloader (manga info, chapter info, ...)
+	"""
+
+	def __init__(self, site: str, kind: str, entry_id: str) :
+		self._site = site
+		self._kind = kind
+		self._id = entry_id
+	
+	def get(self, cur: sqlite3.Cursor) -> "tuple[object,int]" :
+		l = cur.execute("SELECT data, fetched FROM metadata WHERE site=? and kind=? and id=?", [self._site, self._kind, self._id]).fetchall()
+		return (json.loads(l[0][0]), l[0][1]) if len(l) > 0 else None
+	
+	def save(self, cur: sqlite3.Cursor, data, fetched: int) :
+		cur.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)", [self._site, self._kind, self._id, json.dumps(data), fetched])
+	
+	def delete(self, cur: sqlite3.Cursor) :
+		cur.execute("DELETE FROM metadata WHERE site=? and kind=? and id=?", [self._site, self._kind, self._id])
+	
+	def getFetched(cur: sqlite3.Cursor, site: str, kind: str, entry_ids: "list[str]") -> "dict[str,int]" :
+		"""
+		Retrieves when the stored entries among the given ones were fetched
+		"""
+		res = {}
+		for batch in _batches(list(entry_ids)) :
+			l = cur.execute(f"SELECT id, fetched FROM metadata WHERE site=? and kind=? and id IN ({','.join('?' * len(batch))})", [site, kind, *batch]).fetchall()
+			res.update({e[0]: e[1] for e in l})
+		return res
+
+
+class SqlDownloadEntry :
+	"""
+	State of a download that is over, kept in the history of downloads
+	"""
+
+	_columns = "id, site, chapter, file, status, completion, size, created, began, ended"
+
+	def _toState(row) -> "tuple[str,dict]" :
+		state = {
+			'file': row[3],
+			'status': row[4],
+			'completion': row[5],
+			'size': row[6],
+			'created': row[7]
+		}
+		if row[8] is not None :
+			state['begin'] = row[8]
+		if row[9] is not None :
+			state['end'] = row[9]
+		return row[0], state
+
+	def get(cur: sqlite3.Cursor, download_id: str) -> dict :
+		l = cur.execute(f"SELECT {SqlDownloadEntry._columns} FROM downloads WHERE id=?", [download_id]).fetchall()
+		return SqlDownloadEntry._toState(l[0])[1] if len(l) > 0 else None
+	
+	def save(cur: sqlite3.Cursor, download_id: str, site: str, chapter_id: str, state: dict) :
+		cur.execute("INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+			download_id, site, chapter_id, state['file'], state['status'], state['completion'], 
+			state['size'], state['created'], state.get('begin'), state.get('end')
+		])
+	
+	def getPage(cur: sqlite3.Cursor, limit: int, site: str = None, statuses: "list[str]" = None, 
+			since: int = None, until: int = None, cursor: "tuple[int,str]" = None) -> "list[tuple[str,dict]]" :
+		"""
+		Lists the downloads from the most recently created, the cursor being the creation date
+		and the identifier of the last download of the previous page
+		"""
+		conditions, values = [], []
+		if site is not None :
+			conditions.append("site=?")
+			values.append(site)
+		if statuses is not None :
+			conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+			values.extend(statuses)
+		if since is not None :
+			conditions.append("created>=?")
+			values.append(since)
+		if until is not None :
+			conditions.append("created<?")
+			values.append(until)
+		if cursor is not None :
+			conditions.append("(created<? OR (created=? AND id<?))")
+			values.extend([cursor[0], cursor[0], cursor[1]])
+		where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ''
+		rows = cur.execute(f"SELECT {SqlDownloadEntry._columns} FROM downloads {where} ORDER BY created DESC, id DESC LIMIT ?", [*values, limit]).fetchall()
+		return [SqlDownloadEntry._toState(row) for row in rows]
+	
+	def purge(cur: sqlite3.Cursor, before: int) -> int :
+		return cur.execute("DELETE FROM downloads WHERE created<?", [before]).rowcount
+	
+	def clear(cur: sqlite3.Cursor) -> int :
+		return cur.execute("DELETE FROM downloads").rowcount
+
+
+with getConnection(write=True) as con :
 
 	cur = con.cursor()
 
+	# Several workers may create the tables at the same time, the checks only decide what is logged
+
 	if not tableExists(cur, 'chapters') :
 		logger.info('Create table chapters')
 		cur.execute(
 			'''
-			CREATE TABLE chapters (
+			CREATE TABLE IF NOT EXISTS chapters (
 				site VARCHAR(255) NOT NULL,
 				id VARCHAR(255) NOT NULL,
 				manga VARCHAR(255) NOT NULL,
@@ -139,12 +353,69 @@ with getConnection() as con :
 		logger.info('Create table mangas')
 		cur.execute(
 			'''
-			CREATE TABLE mangas (
+			CREATE TABLE IF NOT EXISTS mangas (
+				site VARCHAR(255) NOT NULL,
+				id VARCHAR(255) NOT NULL,
+				PRIMARY KEY (site, id)
+			)
+			'''
+		)
+
+	if not tableExists(cur, 'feeds') :
+		logger.info('Create table feeds')
+		cur.execute(
+			'''
+			CREATE TABLE IF NOT EXISTS feeds (
 				site VARCHAR(255) NOT NULL,
 				id VARCHAR(255) NOT NULL,
+				cursor VARCHAR(255),
+				synced INTEGER NOT NULL,
+				chapters TEXT NOT NULL,
 				PRIMARY KEY (site, id)
 			)
 			'''
 		)
 
+	if not tableExists(cur, 'metadata') :
+		logger.info('Create table metadata')
+		cur.execute(
+			'''
+			CREATE TABLE IF NOT EXISTS metadata (
+				site VARCHAR(255) NOT NULL,
+				kind VARCHAR(31) NOT NULL,
+				id VARCHAR(255) NOT NULL,
+				data TEXT NOT NULL,
+				fetched INTEGER NOT NULL,
+				PRIMARY KEY (site, kind, id)
+			)
+			'''
+		)
+
+	if not tableExists(cur, 'downloads') :
+		logger.info('Create table downloads')
+		cur.execute(
+			'''
+			CREATE TABLE IF NOT EXISTS downloads (
+				id VARCHAR(31) NOT NULL PRIMARY KEY,
+				site VARCHAR(255) NOT NULL,
+				chapter VARCHAR(255) NOT NULL,
+				file VARCHAR(255),
+				status VARCHAR(15) NOT NULL,
+				completion REAL NOT NULL,
+				size INTEGER NOT NULL,
+				created INTEGER NOT NULL,
+				began INTEGER,
+				ended INTEGER
+			)
+			'''
+		)
+
+	if not indexExists(cur, 'downloads_created') :
+		logger.info('Create index downloads_created')
+		cur.execute('CREATE INDEX IF NOT EXISTS downloads_created ON downloads (created, id)')
+
+	if not indexExists(cur, 'chapters_site_manga') :
+		logger.info('Create index chapters_site_manga')
+		cur.execute('CREATE INDEX IF NOT EXISTS chapters_site_manga ON chapters (site, manga)')
+
 	con.commit()
@@ -30,6 +30,17 @@ class ApiConfigurationError(ApiError) :
 		super().__init__(message)
 
 
+def getStatus(e: Exception) -> int :
+	"""
+	Retrieves the HTTP status code corresponding to an error, as returned by the handlers
+	"""
+	if isinstance(e, ApiNotFoundError) :
+		return 404
+	if isinstance(e, ApiFormatError) :
+		return 400
+	return 500
+
+
 def setHandlers(app: Flask) :
 	@app.errorhandler(ApiNotFoundError)
 	def handle_not_found(e) :
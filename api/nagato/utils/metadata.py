@@ -0,0 +1,102 @@
+from nagato.utils.database import getConnection, SqlMetadataEntry
+from nagato.utils.errors import ApiNotFoundError
+
+import time
+import logging
+import threading
+import traceback
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+_mutex = threading.Lock()
+
+# Keys of the entries that are being revalidated
+_refreshing = set()
+
+_refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='nagato_metadata')
+
+
+def _fetchAndSave(entry: SqlMetadataEntry, fetch, entry_id: str) :
+	try :
+		data = fetch(entry_id)
+	except ApiNotFoundError :
+		# The resource no longer exists, there is no point in keeping it
+		with getConnection(write=True) as con :
+			entry.delete(con.cursor())
+			con.commit()
+		raise
+	with getConnection(write=True) as con :
+		entry.save(con.cursor(), data, int(time.time()))
+		con.commit()
+	return data
+
+def _refreshInBackground(key: tuple, entry: SqlMetadataEntry, fetch, entry_id: str) :
+	with _mutex :
+		if key in _refreshing :
+			return
+		_refreshing.add(key)
+	def refresh() :
+		try :
+			_fetchAndSave(entry, fetch, entry_id)
+		except Exception :
+			logger.warning('Could not revalidate %s %s of site %s:\n%s', key[1], entry_id, key[0], traceback.format_exc())
+		finally :
+			with _mutex :
+				_refreshing.discard(key)
+	_refresher.submit(refresh)
+
+
+def persisted(site: str, kind: str, ttl: int, fetch) :
+	"""
+	Wraps a method of a downloader taking an identifier so that its results are stored in the database.
+	A stored result is returned directly, and is revalidated in the background if it is older than `ttl` seconds.
+	The `refresh` attribute of the returned function always calls the method and stores its result,
+	and its `stale` attribute lists the identifiers among the given ones that are not stored or need to be revalidated.
+	Its `store` attribute stores results retrieved by other means, given as a dict associating them with their identifiers.
+	Nothing is stored if `ttl` is not positive.
+	"""
+	if ttl <= 0 :
+		@wraps(fetch)
+		def direct(entry_id) :
+			return fetch(entry_id)
+		direct.refresh = fetch
+		direct.stale = lambda entry_ids : list(entry_ids)
+		direct.store = lambda entries : None
+		return direct
+
+	@wraps(fetch)
+	def wrapper(entry_id) :
+		entry = SqlMetadataEntry(site, kind, entry_id)
+		with getConnection() as con :
+			stored = entry.get(con.cursor())
+		if stored is None :
+			return _fetchAndSave(entry, fetch, entry_id)
+		data, fetched = stored
+		if int(time.time()) - fetched >= ttl :
+			_refreshInBackground((site, kind, entry_id), entry, fetch, entry_id)
+		return data
+	
+	def refresh(entry_id) :
+		return _fetchAndSave(SqlMetadataEntry(site, kind, entry_id), fetch, entry_id)
+	
+	def stale(entry_ids) -> "list[str]" :
+		with getConnection() as con :
+			fetched = SqlMetadataEntry.getFetched(con.cursor(), site, kind, entry_ids)
+		now = int(time.time())
+		return [entry_id for entry_id in entry_ids if entry_id not in fetched or now - fetched[entry_id] >= ttl]
+	
+	def store(entries: dict) :
+		now = int(time.time())
+		with getConnection(write=True) as con :
+			cur = con.cursor()
+			for entry_id, data in entries.items() :
+				SqlMetadataEntry(site, kind, entry_id).save(cur, data, now)
+			con.commit()
+	
+	wrapper.refresh = refresh
+	wrapper.stale = stale
+	wrapper.store = store
+	return wrapper
@@ -5,6 +5,7 @@ from nagato.utils.errors import ApiFormatError, ApiQueryError
 
 import logging
 from functools import wraps
+from urllib.parse import urlsplit
 from flask import request
 
 logger = logging.getLogger(__name__)
@@ -82,11 +83,33 @@ def getChapterRefs(data) :
 			res[site]['chapters'].add(dl.getChapterId(url))
 	return res
 
-def chaptersFromContent(f) :
+def getSiteRefs(data) -> "dict[str,dict[str,list[str]]]" :
+	"""
+	Groups the identifiers and the URLs by site without resolving them, so that each of them can fail on its own.
+	The URLs of unknown sites are grouped by host
+	"""
+	res = {site: {'ids': list(ids), 'urls': []} for site, ids in data['sites'].items()} if 'sites' in data else {}
+	if 'urls' in data :
+		for url in data['urls'] :
+			site = siteForURL(url)
+			if site is None :
+				site = urlsplit(url).netloc or url
+			if site not in res :
+				res[site] = {'ids': [], 'urls': []}
+			res[site]['urls'].append(url)
+	return res
+
+def _refsFromContent(f, getRefs) :
 	@wraps(f)
 	def wrapper(**kwargs) :
 		data = request.get_json(silent=True)
 		if data is None :
 			raise ApiFormatError('Content of request is not well-formed JSON')
-		return f(getChapterRefs(data), **kwargs)
-	return wrapper
\ No newline at end of file
+		return f(getRefs(data), **kwargs)
+	return wrapper
+
+def chaptersFromContent(f) :
+	return _refsFromContent(f, getChapterRefs)
+
+def siteRefsFromContent(f) :
+	return _refsFromContent(f, getSiteRefs)
@@ -1,113 +1,544 @@
 from nagato.utils.errors import ApiConfigurationError, ApiNotFoundError, ApiQueryError
 from nagato.utils import config
 
+import os
+import sys
 import time
+import pickle
+import random
+import sqlite3
+import asyncio
 import logging
+import threading
 import requests
-from collections import deque
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 from time import sleep
 import bs4
 
 logger = logging.getLogger(__name__)
 
 _request_cache_maxlen = config.getApiConf('requests.cache.maxlen')
+_request_cache_maxsize = config.getApiConf('requests.cache.maxsize')
 _request_cache_threshold = config.getApiConf('requests.cache.threshold')
+_request_cache_backend = config.getApiConf('requests.cache.backend')
+_agregate_workers = config.getApiConf('requests.agregate.workers')
 
+if not isinstance(_agregate_workers, int) or _agregate_workers < 1 :
+	raise ApiConfigurationError(f"Invalid number of workers for agregation requests : {_agregate_workers}")
 
+_agregate_executor = ThreadPoolExecutor(max_workers=_agregate_workers, thread_name_prefix='nagato_agregate')
+
+_pool_connections = config.getApiConf('requests.pool.connections')
+_pool_maxsize = config.getApiConf('requests.pool.maxsize')
+
+if _pool_connections < 1 or _pool_maxsize < 0 :
+	raise ApiConfigurationError(f"Invalid sizes for the pools of connections : {_pool_connections} hosts and {_pool_maxsize} connections per host")
+
+if _pool_maxsize == 0 :
+	# Enough connections for the requests a downloader can make at the same time to a host, 
+	# beyond that the connections are closed after each request
+	_pool_maxsize = max(
+		max(conf['chapters.pageworkers'] * conf['chapters.workers'], conf['mangas.workers'])
+		for conf in [config.DownloaderConf(None)] + [config.DownloaderConf(site) for site in config.conf['downloaders']]
+	)
+
+_request_retries = config.getApiConf('requests.retries')
+_request_backoff_base = config.getApiConf('requests.backoff.base')
+_request_backoff_max = config.getApiConf('requests.backoff.max')
+
+if not isinstance(_request_retries, int) or _request_retries < 0 :
+	raise ApiConfigurationError(f"Invalid number of retries for the requests : {_request_retries}")
+
+if _request_backoff_base <= 0 or _request_backoff_max < _request_backoff_base :
+	raise ApiConfigurationError(f"Invalid backoff for the requests, the base ({_request_backoff_base}) must be positive and lower than the maximum ({_request_backoff_max})")
+
+
+class HostLimiter :
+	"""
+	Token bucket limiting the rate of the requests made to a host, shared by all the requesters.
+	The bucket holds at most `burst` tokens and is refilled with `rate` tokens per second,
+	a rate of 0 meaning that the requests are not limited.
+	"""
+
+	def __init__(self, rate: float, burst: int) :
+		self._rate = rate
+		self._burst = burst
+		self._tokens = burst
+		self._last = time.monotonic()
+		self._paused_until = 0
+		self._lock = threading.Lock()
+	
+	def _reserve(self) -> float :
+		# Takes a token if possible, otherwise returns how long to wait before trying again
+		with self._lock :
+			now = time.monotonic()
+			wait = self._paused_until - now
+			if wait > 0 :
+				return wait
+			if self._rate <= 0 :
+				return 0
+			self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+			self._last = now
+			if self._tokens >= 1 :
+				self._tokens -= 1
+				return 0
+			return (1 - self._tokens) / self._rate
+	
+	def acquire(self) :
+		"""
+		Waits until a request can be made to the host
+		"""
+		wait = self._reserve()
+		while wait > 0 :
+			sleep(wait)
+			wait = self._reserve()
+	
+	async def acquireAsync(self) :
+		"""
+		Same as `acquire`, without blocking the event loop
+		"""
+		wait = self._reserve()
+		while wait > 0 :
+			await asyncio.sleep(wait)
+			wait = self._reserve()
+	
+	def pause(self, duration: float) :
+		"""
+		Prevents any request to the host for some time, typically when asked to by a `Retry-After` header
+		"""
+		with self._lock :
+			self._paused_until = max(self._paused_until, time.monotonic() + duration)
+
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+def getHostLimiter(url: str, rate: float = 0, burst: int = 1) -> HostLimiter :
+	"""
+	Retrieves the limiter of the host of a URL, creating it with the given rate if it doesn't exist yet
+	"""
+	host = urlsplit(url).netloc
+	with _host_limiters_lock :
+		if host not in _host_limiters :
+			_host_limiters[host] = HostLimiter(rate, burst)
+		return _host_limiters[host]
+
+
+def retryAfter(response: requests.Response) :
+	"""
+	Retrieves the number of seconds to wait given by the `Retry-After` header of a response, or None
+	"""
+	value = response.headers.get('Retry-After')
+	if value is None :
+		return None
+	try :
+		return max(0.0, float(value))
+	except ValueError :
+		pass
+	try :
+		date = parsedate_to_datetime(value)
+	except (TypeError, ValueError) :
+		return None
+	if date.tzinfo is None :
+		date = date.replace(tzinfo=timezone.utc)
+	return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff(nb_attempts: int) -> float :
+	"""
+	Exponential backoff with jitter, in seconds, before a new attempt of a request
+	"""
+	duration = min(_request_backoff_max, _request_backoff_base * 2 ** (nb_attempts - 1))
+	return random.uniform(duration / 2, duration)
+
+
+def retryOnStatus(url: str, status: int, reason: str, nb_attempts: int) -> bool :
+	"""
+	Decides if a request that failed with a status code is attempted again, 
+	raising the corresponding error if the failure is definitive
+	"""
+	if status == 404 :
+		raise ApiNotFoundError(f"Could not find resource at {url}")
+	if status in (429, 503) :
+		return nb_attempts <= _request_retries
+	raise ApiQueryError(f"Request to {url} failed with return code {status} {reason}")
+
+def retryDelay(url: str, nb_attempts: int, wait: float = None) -> "tuple[float,bool]" :
+	"""
+	Decides how long to wait before attempting a failed request again, given the time the host asked to wait (if it did).
+	Returns None if the request must not be attempted again, otherwise the time in seconds 
+	and whether all the requests to the host must wait (when the host asked for it)
+	"""
+	if wait is None :
+		return backoff(nb_attempts), False
+	if wait > _request_backoff_max :
+		logger.warning(f"Not retrying the request to {url}, the host asked to wait for {wait} seconds")
+		return None
+	return wait, True
+
+
+_cache_backends = {}
+
+def cache_backend(name: str) :
+	"""
+	Decorator used to register a class as a backend for the cache of HTTP requests
+	"""
+	def annotation(c) :
+		_cache_backends[name] = c
+		return c
+	return annotation
+
+
+def estimateSize(obj) -> int :
+	"""
+	Estimates the memory used by an object, including the objects it contains
+	"""
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict) :
+		size += sum(estimateSize(k) + estimateSize(v) for k, v in obj.items())
+	elif isinstance(obj, (list, tuple, set)) :
+		size += sum(estimateSize(e) for e in obj)
+	return size
+
+
+@cache_backend('memory')
 class HttpCache :
 	"""
-	Used for caching the responses of HTTP requests
+	Used for caching the responses of HTTP requests, in the memory of the current process.
+	The least recently used entries are discarded when there are more than `maxlen` entries
+	or when their estimated size exceeds `maxsize` bytes (if `maxsize` is not zero).
 	"""
 	
-	def __init__(self, maxlen, threshold) :
+	def __init__(self, maxlen, threshold, maxsize=0) :
 		self._maxlen = maxlen
 		self._threshold = threshold
-		self._saved_requests = {}
-		self._urls = deque(maxlen = maxlen)
+		self._maxsize = maxsize
+		self._saved_requests: "OrderedDict[str,tuple]" = OrderedDict()
+		self._size = 0
+		self._lock = threading.Lock()
+		self._hits = 0
+		self._misses = 0
+		self._evictions = 0
+		self._expirations = 0
 	
 	def checkValid(self, ts: int) -> bool :
-		return ts - int(time.time()) < self._threshold
+		return int(time.time()) - ts < self._threshold
 
 	def get(self, url) :
-		if url in self._saved_requests :
-			self._urls.remove(url)
-			res, ts = self._saved_requests[url]
-			if self.checkValid(ts) :
-				self._urls.append(url)
-				return res
-			else :
+		with self._lock :
+			entry = self._saved_requests.get(url)
+			if entry is None :
+				self._misses += 1
+				return None
+			res, ts, size = entry
+			if not self.checkValid(ts) :
 				del self._saved_requests[url]
-		return None
+				self._size -= size
+				self._expirations += 1
+				self._misses += 1
+				return None
+			self._saved_requests.move_to_end(url)
+			self._hits += 1
+			return res
 	
 	def add(self, url, response) :
-		if len(self._saved_requests) == self._maxlen :
-			oldest = self._urls.popleft()
-			del self._saved_requests[oldest]
-		self._saved_requests[url] = response, int(time.time())
-		self._urls.append(url)
+		size = estimateSize(response)
+		if self._maxsize > 0 and size > self._maxsize :
+			logger.info('Response of %s is too big to be cached (%d bytes)', url, size)
+			return
+		with self._lock :
+			if url in self._saved_requests :
+				self._size -= self._saved_requests.pop(url)[2]
+			self._saved_requests[url] = response, int(time.time()), size
+			self._size += size
+			while len(self._saved_requests) > self._maxlen or (self._maxsize > 0 and self._size > self._maxsize) :
+				_, (_, _, evicted_size) = self._saved_requests.popitem(last=False)
+				self._size -= evicted_size
+				self._evictions += 1
+
+	def getStats(self) -> dict :
+		with self._lock :
+			return {
+				'backend': 'memory',
+				'entries': len(self._saved_requests),
+				'size': self._size,
+				'maxlen': self._maxlen,
+				'maxsize': self._maxsize,
+				'hits': self._hits,
+				'misses': self._misses,
+				'evictions': self._evictions,
+				'expirations': self._expirations
+			}
+
+
+@cache_backend('sqlite')
+class SqliteHttpCache :
+	"""
+	Used for caching the responses of HTTP requests in an SQLite file, 
+	so that the cache is shared by all the processes of the API.
+	The size of an entry is the size of the serialised response.
+	"""
+
+	# Minimum time in seconds between two updates of the last access time of an entry
+	_access_resolution = 60
+
+	def __init__(self, maxlen, threshold, maxsize=0) :
+		path: str = config.getApiConf('requests.cache.path')
+		if not path.startswith('/') :
+			path = os.path.join(config.API_DIR, path)
+		self._path = path
+		self._maxlen = maxlen
+		self._threshold = threshold
+		self._maxsize = maxsize
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._hits = 0
+		self._misses = 0
+		self._evictions = 0
+		self._expirations = 0
+		with self._connection() as con :
+			con.execute(
+				'''
+				CREATE TABLE IF NOT EXISTS requests (
+					url TEXT NOT NULL PRIMARY KEY,
+					response BLOB NOT NULL,
+					ts INTEGER NOT NULL,
+					last_access REAL NOT NULL
+				)
+				'''
+			)
+			con.execute('CREATE INDEX IF NOT EXISTS requests_last_access ON requests (last_access)')
+
+	def _connection(self) -> sqlite3.Connection :
+		# One connection per thread, reopened in processes forked after its creation
+		if getattr(self._local, 'pid', None) != os.getpid() :
+			con = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+			con.execute('PRAGMA journal_mode=WAL')
+			con.execute('PRAGMA synchronous=NORMAL')
+			self._local.con = con
+			self._local.pid = os.getpid()
+		return self._local.con
+
+	def _count(self, counter: str) :
+		with self._lock :
+			setattr(self, counter, getattr(self, counter) + 1)
+
+	def checkValid(self, ts: int) -> bool :
+		return int(time.time()) - ts < self._threshold
+
+	def get(self, url) :
+		con = self._connection()
+		row = con.execute('SELECT response, ts, last_access FROM requests WHERE url=?', [url]).fetchone()
+		if row is None :
+			self._count('_misses')
+			return None
+		# Writes fail when the database is locked by a writer, which doesn't prevent reading the entry
+		if not self.checkValid(row[1]) :
+			try :
+				con.execute('DELETE FROM requests WHERE url=? AND ts=?', [url, row[1]])
+			except sqlite3.OperationalError as e :
+				logger.debug('Could not delete the cache entry of %s: %s', url, e)
+			self._count('_expirations')
+			self._count('_misses')
+			return None
+		# The eviction order doesn't need to be exact, and writing on every hit serialises the readers
+		now = time.time()
+		if now - row[2] >= SqliteHttpCache._access_resolution :
+			try :
+				con.execute('UPDATE requests SET last_access=? WHERE url=?', [now, url])
+			except sqlite3.OperationalError as e :
+				logger.debug('Could not update the cache entry of %s: %s', url, e)
+		self._count('_hits')
+		return pickle.loads(row[0])
+
+	def add(self, url, response) :
+		con = self._connection()
+		data = pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+		if self._maxsize > 0 and len(data) > self._maxsize :
+			logger.info('Response of %s is too big to be cached (%d bytes)', url, len(data))
+			return
+		now = time.time()
+		with con :
+			con.execute('BEGIN IMMEDIATE')
+			con.execute('INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?)', [url, data, int(now), now])
+			evicted = con.execute(
+				'''
+				DELETE FROM requests WHERE url IN (
+					SELECT url FROM requests ORDER BY last_access DESC LIMIT -1 OFFSET ?
+				)
+				''', 
+				[self._maxlen]
+			).rowcount
+			if self._maxsize > 0 :
+				evicted += con.execute(
+					'''
+					DELETE FROM requests WHERE url IN (
+						SELECT url FROM (
+							SELECT url, SUM(LENGTH(response)) OVER (ORDER BY last_access DESC) AS total FROM requests
+						) WHERE total > ?
+					)
+					''', 
+					[self._maxsize]
+				).rowcount
+		with self._lock :
+			self._evictions += evicted
+
+	def getStats(self) -> dict :
+		entries, size = self._connection().execute('SELECT COUNT(*), TOTAL(LENGTH(response)) FROM requests').fetchone()
+		with self._lock :
+			return {
+				'backend': 'sqlite',
+				'entries': entries,
+				'size': int(size),
+				'maxlen': self._maxlen,
+				'maxsize': self._maxsize,
+				'hits': self._hits,
+				'misses': self._misses,
+				'evictions': self._evictions,
+				'expirations': self._expirations
+			}
+
 
 if _request_cache_threshold < 60 :
 	raise ApiConfigurationError(f"The threshold for the request cache must be greater than a minute, but was set to {_request_cache_threshold} seconds")
 
+if _request_cache_maxsize < 0 :
+	raise ApiConfigurationError(f"The maximum size of the request cache must be positive, but was set to {_request_cache_maxsize} bytes")
+
+if _request_cache_backend not in _cache_backends :
+	raise ApiConfigurationError(f"Unrecognized backend for the request cache : {_request_cache_backend}")
+
 if _request_cache_maxlen > 0 :
-	_request_cache = HttpCache(_request_cache_maxlen, _request_cache_threshold)
+	_request_cache = _cache_backends[_request_cache_backend](_request_cache_maxlen, _request_cache_threshold, _request_cache_maxsize)
 else :
 	_request_cache = None
 
 
+def getCacheStats() -> dict :
+	"""
+	Retrieves the usage statistics of the cache, the counters being those of the current process
+	"""
+	if _request_cache is None :
+		return {'backend': None}
+	return _request_cache.getStats()
+
+
+# Requests whose result will be cached that are being performed, by URL
+_inflight_requests: "dict[str,Future]" = {}
+_inflight_lock = threading.Lock()
+
+def _singleFlight(url: str, fetch) :
+	"""
+	Calls `fetch` unless another thread is already retrieving the result for this URL,
+	in which case its result (or error) is shared instead of requesting the URL again
+	"""
+	with _inflight_lock :
+		future = _inflight_requests.get(url)
+		leader = future is None
+		if leader :
+			future = _inflight_requests[url] = Future()
+	if not leader :
+		return future.result()
+	try :
+		res = fetch()
+	except BaseException as e :
+		future.set_exception(e)
+		raise
+	finally :
+		with _inflight_lock :
+			del _inflight_requests[url]
+	future.set_result(res)
+	return res
+
+
 class Requester :
 	"""
 	Pre-configured object for making HTTP requests and interacting with the cache
 	"""
 	
-	def __init__(self, verb, headers={}, handlers={}, ceh=None, timeout=None) :
+	def __init__(self, verb, headers={}, handlers={}, ceh=None, timeout=None, ratelimit=(0, 1), session=None) :
 		self._verb = verb
 		self._headers = headers
 		self._handlers = handlers
 		self._connectionErrorHandle = ceh if ceh is not None else Requester.defaultConnectionErrorHandle
 		self._timeout = timeout
+		self._ratelimit = ratelimit
+		# Without a session, a new connection is opened for each request
+		self._session = session if session is not None else requests
 	
-	def defaultConnectionErrorHandle(error, _) :
-		raise ApiQueryError(error)
+	def defaultConnectionErrorHandle(error, nb_attempts) :
+		return nb_attempts <= _request_retries
 
-	def _request(self, url) :
-		return requests.request(self._verb, url, headers=self._headers, timeout=self._timeout)
+	def _request(self, url, headers=None) :
+		if headers is not None :
+			headers = {**self._headers, **headers}
+		else :
+			headers = self._headers
+		return self._session.request(self._verb, url, headers=headers, timeout=self._timeout)
 
-	def _handleRequest(self, url, delay=0) -> requests.Response :
+	def _handleRequest(self, url, delay=0, headers=None) -> requests.Response :
 		if delay > 0 :
 			sleep(delay)
+		limiter = getHostLimiter(url, *self._ratelimit)
 		keep_going = True
 		nb_attempts = 0
 		while keep_going :
 			nb_attempts += 1
-			logging.info(f"Request to \"{url}\"")
+			limiter.acquire()
+			logger.info(f"Request to \"{url}\"")
+			wait = None
 			try :
-				res = self._request(url)
+				res = self._request(url, headers)
 				if res.ok :
 					return res
 				logger.warning(f"Request n°{nb_attempts} to {url} failed with return code {res.status_code} {res.reason} : {res.text}")
+				failure = f"return code {res.status_code} {res.reason}"
 				if res.status_code in self._handlers :
 					keep_going = self._handlers[res.status_code](res, nb_attempts)
-				elif res.status_code == 404 :
-					raise ApiNotFoundError(f"Could not find resource at {url}")
 				else :
-					raise ApiQueryError(f"Request to {url} failed with return code {res.status_code} {res.reason}")
-			except ConnectionError as e :
+					keep_going = retryOnStatus(url, res.status_code, res.reason, nb_attempts)
+					wait = retryAfter(res)
+			except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e :
 				logger.warning(f"Request n°{nb_attempts} to {url} failed with error of type {type(e).__name__}")
+				failure = f"error of type {type(e).__name__}"
 				keep_going = self._connectionErrorHandle(e, nb_attempts)
-		raise ApiQueryError(f"Request to {url} failed after {nb_attempts} attempts with return code {res.status_code} {res.reason}")
+			retry = retryDelay(url, nb_attempts, wait) if keep_going else None
+			if retry is None :
+				break
+			duration, overloaded = retry
+			if overloaded :
+				# The host is overloaded, so all the requests to it must wait
+				limiter.pause(duration)
+			else :
+				sleep(duration)
+		raise ApiQueryError(f"Request to {url} failed after {nb_attempts} attempts with {failure}")
 	
 	def requestMap(self, url, mapper, cache=True, delay=0) :
 		if cache :
 			res = _request_cache.get(url)
 			if res is not None :
 				return res
+			return _singleFlight(url, lambda : self._mapAndCache(url, mapper, delay))
+		with self._handleRequest(url, delay) as response :
+			return mapper(response)
+	
+	def _mapAndCache(self, url, mapper, delay=0) :
 		with self._handleRequest(url, delay) as response :
 			res = mapper(response)
-		if cache :
-			_request_cache.add(url, res)
+		_request_cache.add(url, res)
 		return res
 	
+	def addToCache(self, url, res) :
+		"""
+		Saves a result in the cache as if it had been obtained by a request to the URL
+		"""
+		_request_cache.add(url, res)
+	
 	def requestSoup(self, url, mapper, cache=True, delay=0) :
 		soup_mapper = lambda r : mapper(bs4.BeautifulSoup(r.text, features="lxml"))
 		return self.requestMap(url, soup_mapper, cache, delay)
@@ -118,25 +549,68 @@ class Requester :
 	def requestJson(self, url, cache=True, delay=0) :
 		return self.requestMap(url, lambda r : r.json(), cache, delay)
 	
+	def requestRevalidate(self, url, etag=None, last_modified=None, delay=0) -> "tuple[bytes,str,str]" :
+		"""
+		Requests a binary resource only if it changed since it was last retrieved, using the validators
+		(`ETag` and `Last-Modified` headers) of the previous response. Never cached.
+		Returns the content of the resource or None if it didn't change, along with the new validators
+		"""
+		headers = {}
+		if etag is not None :
+			headers['If-None-Match'] = etag
+		if last_modified is not None :
+			headers['If-Modified-Since'] = last_modified
+		with self._handleRequest(url, delay, headers) as response :
+			content = None if response.status_code == 304 else response.content
+			return content, response.headers.get('ETag', etag), response.headers.get('Last-Modified', last_modified)
+	
 	def requestAgregate(self, url, agregator, cache=True, delay=0) :
 		if cache :
 			res = _request_cache.get(url)
 			if res is not None :
 				return res
+			return _singleFlight(url, lambda : self._agregateAndCache(url, agregator, delay))
+		return self._agregate(url, agregator, delay)
+	
+	def _agregateAndCache(self, url, agregator, delay=0) :
+		res = self._agregate(url, agregator, delay)
+		_request_cache.add(url, res)
+		return res
+	
+	def _agregate(self, url, agregator, delay=0) :
+		"""
+		Follows the URLs returned by the agregator until it returns None.
+		When the agregator returns a list of URLs, they are requested concurrently
+		and their responses are given to the agregator in the order of the list
+		"""
 		res = None
-		next_url = url
+		next_urls = [url]
 		state = {}
-		visited = [url]
-		while next_url is not None :
-			with self._handleRequest(next_url, delay) as response :
-				res, next_url = agregator(response, res, state)
-			if next_url is not None :
+		visited = {url}
+		while len(next_urls) > 0 :
+			if len(next_urls) == 1 :
+				responses = [self._handleRequest(next_urls[0], delay)]
+			else :
+				futures = [_agregate_executor.submit(self._handleRequest, u, delay) for u in next_urls]
+				try :
+					responses = [f.result() for f in futures]
+				finally :
+					for f in futures :
+						f.cancel()
+			for response in responses :
+				with response :
+					res, next_url = agregator(response, res, state)
+			if next_url is None :
+				next_urls = []
+			elif isinstance(next_url, str) :
+				next_urls = [next_url]
+			else :
+				next_urls = list(next_url)
+			for next_url in next_urls :
 				if next_url in visited :
 					raise ApiQueryError(f"Loop detected in agregation request to url {url} with state {state}")
 				logger.info('Request redirected to %s (redirection n°%d)', next_url, len(visited))
-				visited.append(next_url)
-		if cache :
-			_request_cache.add(url, res)
+				visited.add(next_url)
 		return res
 	
 	def __enter__(self) :
@@ -147,61 +621,20 @@ class Requester :
 			return False
 
 	
-class SessionRequester(Requester) :
-	"""
-	Requester that uses a session to perform bulk requests.
-	Should always be used in a `with ... as ...` block.
-	"""
-
-	def __init__(self, verb, headers={}, handlers={}, ceh=None, timeout=None) :
-		super().__init__(verb, headers, handlers, ceh, timeout)
-		self._session = requests.session()
-
-	def _request(self, url) :
-		return self._session.request(self._verb, url, headers=self._headers)
-	
-	def __exit__(self, exc_type, exc_value, tb) :
-		self._session.close()
-		return super().__exit__(exc_type, exc_value, tb)
-
-
 class RequesterNoCache(Requester) :
 
-	def __init__(self, verb, headers={}, handlers={}, ceh=None, timeout=None) :
-		super().__init__(verb, headers, handlers, ceh, timeout)
+	def __init__(self, verb, headers={}, handlers={}, ceh=None, timeout=None, ratelimit=(0, 1), session=None) :
+		super().__init__(verb, headers, handlers, ceh, timeout, ratelimit, session)
 	
 	def requestMap(self, url, mapper, cache=False, delay=0) :
 		with self._handleRequest(url, delay) as response :
 			return mapper(response)
 	
-	def requestAgregate(self, url, agregator, cache=False, delay=0) :
-		res = None
-		next_url = url
-		visited = [url]
-		state = {}
-		while next_url is not None :
-			with self._handleRequest(next_url, delay) as response :
-				res, next_url = agregator(response, res, state)
-			if next_url is not None :
-				if next_url in visited :
-					raise ApiQueryError(f"Loop detected in agregation request to url {url} with state {state}")
-				logger.info('Request redirected to %d (redirection n°%d)', next_url, len(visited))
-				visited.append(next_url)
-		return res
-
-
-class SessionRequesterNoCache(RequesterNoCache) :
-
-	def __init__(self, verb, headers={}, handlers={}, ceh=None, timeout=None) :
-		super().__init__(verb, headers, handlers, ceh, timeout)
-		self._session = requests.session()
-
-	def _request(self, url) :
-		return self._session.request(self._verb, url, headers=self._headers)
+	def addToCache(self, url, res) :
+		pass
 	
-	def __exit__(self, exc_type, exc_value, tb) :
-		self._session.close()
-		return super().__exit__(exc_type, exc_value, tb)
+	def requestAgregate(self, url, agregator, cache=False, delay=0) :
+		return self._agregate(url, agregator, delay)
 
 
 class RequesterBuilder :
@@ -212,6 +645,12 @@ class RequesterBuilder :
 		self._handlers = {}
 		self._connectionErrorHandler = None
 		self._timeout = (config.getApiConf('requests.timeout.connect'), config.getApiConf('requests.timeout.read'))
+		self._ratelimit = (0, 1)
+		# Connections are kept alive and shared by all the requesters built from this builder
+		self._session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=_pool_connections, pool_maxsize=_pool_maxsize)
+		self._session.mount('http://', adapter)
+		self._session.mount('https://', adapter)
 	
 	def get() :
 		return RequesterBuilder('GET')
@@ -251,14 +690,33 @@ class RequesterBuilder :
 	
 	def setTimeout(self, timeout) :
 		self._timeout = timeout
+	
+	def setRateLimit(self, rate: float, burst: int = 1) :
+		"""
+		Limits the requests to at most `rate` per second and per host, with bursts of at most `burst` requests.
+		The limit of a host is shared by all the requesters, and set by the first one that makes a request to it
+		"""
+		self._ratelimit = (rate, burst)
+		return self
 
 	def build(self) -> Requester :
 		if _request_cache_maxlen > 0 :
-			return Requester(self._verb, self._headers, self._handlers, self._connectionErrorHandler, self._timeout)
-		return RequesterNoCache(self._verb, self._headers, self._handlers, self._connectionErrorHandler, self._timeout)
+			return Requester(self._verb, self._headers, self._handlers, self._connectionErrorHandler, self._timeout, self._ratelimit, self._session)
+		return RequesterNoCache(self._verb, self._headers, self._handlers, self._connectionErrorHandler, self._timeout, self._ratelimit, self._session)
 
 	def session(self) -> Requester :
-		if _request_cache_maxlen > 0 :
-			return SessionRequester(self._verb, self._headers, self._handlers, self._connectionErrorHandler, self._timeout)
-		return SessionRequesterNoCache(self._verb, self._headers, self._handlers, self._connectionErrorHandler, self._timeout)
+		"""
+		Builds a requester for bulk requests. All the requesters built from this builder
+		share its pool of connections, so this is the same as `build`
+		"""
+		return self.build()
 
+	def buildAsync(self) :
+		"""
+		Builds a requester for the asyncio download engine, see `nagato.utils.aio`.
+		Returns None if the builder has custom handlers, which only work with the blocking requesters
+		"""
+		from nagato.utils.aio import AsyncRequester
+		if len(self._handlers) > 0 or self._connectionErrorHandler is not None :
+			return None
+		return AsyncRequester(self._verb, self._headers, self._timeout, self._ratelimit)
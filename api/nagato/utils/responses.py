@@ -0,0 +1,62 @@
+from nagato.utils.errors import ApiConfigurationError
+from nagato.utils import config
+
+import gzip
+import json
+import hashlib
+import logging
+from flask import Response, request
+
+try :
+	import brotli
+except ImportError :
+	brotli = None
+
+logger = logging.getLogger(__name__)
+
+_compression = config.getApiConf('responses.compression')
+_compression_minsize = config.getApiConf('responses.compression.minsize')
+
+if _compression_minsize < 0 :
+	raise ApiConfigurationError(f"The minimum size of the compressed responses must be positive, but was set to {_compression_minsize} bytes")
+
+
+def _chooseEncoding(size: int) :
+	if not _compression or size < _compression_minsize :
+		return None
+	# Brotli is only used if the module is installed and the client prefers it at least as much as gzip
+	if brotli is not None and request.accept_encodings['br'] > 0 and request.accept_encodings['br'] >= request.accept_encodings['gzip'] :
+		return 'br'
+	if request.accept_encodings['gzip'] > 0 :
+		return 'gzip'
+	return None
+
+def _compress(body: bytes, encoding: str) -> bytes :
+	if encoding == 'br' :
+		return brotli.compress(body)
+	return gzip.compress(body, compresslevel=6)
+
+
+def jsonResponse(data) -> Response :
+	"""
+	Creates a JSON response with an ETag computed from its content, which becomes an empty `304`
+	response if the request has a matching `If-None-Match` header. The body is compressed
+	with gzip or brotli if the client accepts it.
+	"""
+	body = json.dumps(data).encode()
+	encoding = _chooseEncoding(len(body))
+	etag = hashlib.sha1(body).hexdigest()
+	if encoding is not None :
+		# Each encoding is a different representation, with its own ETag
+		etag = f"{etag}-{encoding}"
+	response = Response(body, 200, content_type='application/json')
+	response.set_etag(etag)
+	response.vary.add('Accept-Encoding')
+	# The client can keep the response, but must revalidate it each time
+	response.cache_control.no_cache = True
+	response.make_conditional(request)
+	if response.status_code == 304 or encoding is None :
+		return response
+	response.set_data(_compress(body, encoding))
+	response.content_encoding = encoding
+	return response
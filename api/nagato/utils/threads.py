@@ -1,34 +1,66 @@
-from nagato.utils.errors import ApiNotFoundError
+from nagato.utils.errors import ApiNotFoundError, ApiFormatError
 from nagato.utils.compression import Archiver
-from nagato.utils.database import getConnection, ChapterMark, SqlChapterEntry
+from nagato.utils.database import getConnection, ChapterMark, SqlChapterEntry, SqlDownloadEntry
+from nagato.utils.errors import ApiConfigurationError
+from nagato.utils import config, aio
 
 import time
+import queue
+import asyncio
 import hashlib
 import logging
 import threading
 import traceback
 from enum import Enum
 from base64 import b64encode
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 logger = logging.getLogger(__name__)
 
 
+# Serialises the modifications of the registry of downloads, reading it doesn't require the mutex
 mutex = threading.Lock()
 
+# Downloads that are not over. This dict is never modified but replaced by a modified copy, 
+# so that readers can iterate over it without the mutex
 _active_downloads: "dict[str,ChapterDownload]" = {}
 
-_completed_downloads = {}
+# Most recent downloads that are over, the whole history being stored in the database.
+# Only accessed by key without the mutex, the states it contains are never modified
+_completed_downloads: "OrderedDict[str,dict]" = OrderedDict()
 
-_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='nagato_dl')
+_history_maxlen = config.getApiConf('downloads.history.maxlen')
+
+if _history_maxlen < 0 :
+	raise ApiConfigurationError(f"The number of downloads kept in memory must be positive, but was set to {_history_maxlen}")
+
+_history_maxage = config.getApiConf('downloads.history.maxage')
+
+if _history_maxage < 0 :
+	raise ApiConfigurationError(f"The duration for which downloads are kept in the history must be positive, but was set to {_history_maxage} seconds")
+
+_download_workers = config.getApiConf('downloads.workers')
+
+if _download_workers < 1 :
+	raise ApiConfigurationError(f"The number of download workers must be at least 1, but was set to {_download_workers}")
+
+_resolve_workers = config.getApiConf('downloads.resolvers')
+
+if _resolve_workers < 1 :
+	raise ApiConfigurationError(f"The number of resolver workers must be at least 1, but was set to {_resolve_workers}")
+
+# Retrieves the metadata of the chapters before they are queued for download
+_resolver = ThreadPoolExecutor(max_workers=_resolve_workers, thread_name_prefix='nagato_resolve')
 
 
 class DownloadState(Enum) :
 	CREATED    = 0
-	QUEUED     = 1
-	PROCESSING = 2
-	SAVING     = 3
-	COMPLETE   = 4
+	RESOLVING  = 1
+	QUEUED     = 2
+	PROCESSING = 3
+	SAVING     = 4
+	COMPLETE   = 5
 	FAILED     = -1
 	CANCELLED  = -2
 
@@ -58,6 +90,191 @@ class MutexLock() :
 			return False
 
 
+class DownloadScheduler :
+	"""
+	Runs submitted tasks on a fixed number of worker threads, limiting the number 
+	of tasks running at the same time for each site and alternating between the 
+	sites that have pending tasks in a round-robin fashion
+	"""
+
+	def __init__(self, max_workers: int, thread_name_prefix: str) :
+		self._cond = threading.Condition()
+		self._queues: "dict[str,deque]" = {}
+		self._running: "dict[str,int]" = {}
+		self._limits: "dict[str,int]" = {}
+		self._order = deque()
+		self._startWorkers(max_workers, thread_name_prefix)
+
+	def _startWorkers(self, max_workers: int, thread_name_prefix: str) :
+		self._workers = [
+			threading.Thread(target=self._work, name=f"{thread_name_prefix}_{i}", daemon=True) 
+			for i in range(max_workers)
+		]
+		for worker in self._workers :
+			worker.start()
+
+	def setSiteLimit(self, site: str, limit: int) :
+		if limit < 1 :
+			raise ApiConfigurationError(f"The number of workers for site {site} must be at least 1, but was set to {limit}")
+		with self._cond :
+			self._limits[site] = limit
+			self._cond.notify_all()
+
+	def submit(self, site: str, fn) -> Future :
+		future = Future()
+		with self._cond :
+			if site not in self._queues :
+				self._queues[site] = deque()
+				self._running[site] = 0
+			if len(self._queues[site]) == 0 :
+				self._order.append(site)
+			self._queues[site].append((future, fn))
+			self._cond.notify()
+		return future
+
+	def _pop(self) :
+		# Must be called with the condition held
+		for _ in range(len(self._order)) :
+			site = self._order[0]
+			# The site goes to the end of the line, so that the next pick starts with another site
+			self._order.rotate(-1)
+			queue = self._queues[site]
+			while len(queue) > 0 and queue[0][0].cancelled() :
+				queue.popleft()
+			if len(queue) > 0 and self._running[site] < self._limits.get(site, 1) :
+				future, fn = queue.popleft()
+				self._running[site] += 1
+				if len(queue) == 0 :
+					self._order.remove(site)
+				return site, future, fn
+			if len(queue) == 0 :
+				self._order.remove(site)
+		return None
+
+	def _work(self) :
+		while True :
+			with self._cond :
+				task = self._pop()
+				while task is None :
+					self._cond.wait()
+					task = self._pop()
+			site, future, fn = task
+			try :
+				if future.set_running_or_notify_cancel() :
+					try :
+						future.set_result(fn())
+					except BaseException as e :
+						future.set_exception(e)
+			finally :
+				with self._cond :
+					self._running[site] -= 1
+					self._cond.notify_all()
+
+
+class AsyncScheduler(DownloadScheduler) :
+	"""
+	Same as `DownloadScheduler` for the asyncio engine : the tasks are coroutine functions run 
+	on the event loop of the engine, so that the downloads don't each hold a thread
+	"""
+
+	def __init__(self, max_tasks: int) :
+		super().__init__(max_tasks, 'nagato_dl')
+
+	def _startWorkers(self, max_workers: int, thread_name_prefix: str) :
+		# No worker thread, only the number of tasks running on the event loop is limited
+		self._max_tasks = max_workers
+		self._nb_running = 0
+
+	def setSiteLimit(self, site: str, limit: int) :
+		super().setSiteLimit(site, limit)
+		aio.getLoop().call_soon_threadsafe(self._dispatch)
+
+	def submit(self, site: str, fn) -> Future :
+		future = super().submit(site, fn)
+		aio.getLoop().call_soon_threadsafe(self._dispatch)
+		return future
+
+	def _dispatch(self) :
+		# Must be called from the event loop
+		with self._cond :
+			while self._nb_running < self._max_tasks :
+				task = self._pop()
+				if task is None :
+					break
+				self._nb_running += 1
+				asyncio.ensure_future(self._run(*task))
+
+	async def _run(self, site: str, future: Future, fn) :
+		loop = asyncio.get_running_loop()
+		try :
+			if future.set_running_or_notify_cancel() :
+				# The callbacks of the future write to the database, so they are run in the executor
+				try :
+					result = await fn()
+				except BaseException as e :
+					await loop.run_in_executor(None, future.set_exception, e)
+				else :
+					await loop.run_in_executor(None, future.set_result, result)
+		finally :
+			with self._cond :
+				self._running[site] -= 1
+				self._nb_running -= 1
+			self._dispatch()
+
+if aio.isEnabled() :
+	_scheduler = AsyncScheduler(_download_workers)
+else :
+	_scheduler = DownloadScheduler(_download_workers, 'nagato_dl')
+
+def setSiteLimit(site: str, limit: int) :
+	_scheduler.setSiteLimit(site, limit)
+
+
+def prefetchChapters(downloader, chapter_ids: "list[str]") -> Future :
+	"""
+	Retrieves the information on several chapters in the background, 
+	the resulting future can be given to the downloads of these chapters
+	"""
+	def prefetch() :
+		try :
+			downloader.prefetchChapters(chapter_ids)
+		except Exception :
+			logger.warning('Could not prefetch %d chapters:\n%s', len(chapter_ids), traceback.format_exc())
+	return _resolver.submit(prefetch)
+
+
+# Queues of the clients following the events of the downloads
+_subscribers: "list[queue.Queue]" = []
+
+_subscribers_lock = threading.Lock()
+
+_subscriber_maxlen = 1000
+
+def subscribe() -> queue.Queue :
+	"""
+	Registers a new queue that receives the events of all the downloads, 
+	as tuples with the type of event (`state` or `progress`) and its data
+	"""
+	q = queue.Queue(_subscriber_maxlen)
+	with _subscribers_lock :
+		_subscribers.append(q)
+	return q
+
+def unsubscribe(q: queue.Queue) :
+	with _subscribers_lock :
+		_subscribers.remove(q)
+
+def _publish(event_type: str, data: dict) :
+	with _subscribers_lock :
+		subscribers = list(_subscribers)
+	for q in subscribers :
+		try :
+			q.put_nowait((event_type, data))
+		except queue.Full :
+			# The client is not reading its events, there is no point in blocking the download for it
+			logger.warning('Dropped an event of download %s for a slow subscriber', data['id'])
+
+
 def _generateId(t, filename) :
 	for _ in range(10) :
 		digest = hashlib.md5(f"{t}-{filename}".encode()).digest()
@@ -69,6 +286,19 @@ def _generateId(t, filename) :
 def _timestamp() :
 	return int(time.time() * 1000)
 
+def _addActive(download: "ChapterDownload") :
+	global _active_downloads
+	_active_downloads = {**_active_downloads, download._id: download}
+
+def _removeActive(download_id: str) -> bool :
+	global _active_downloads
+	if download_id not in _active_downloads :
+		return False
+	active = dict(_active_downloads)
+	del active[download_id]
+	_active_downloads = active
+	return True
+
 
 class ChapterDownload :
 
@@ -76,25 +306,58 @@ class ChapterDownload :
 		self._downloader = downloader
 		self._chapter = chapter_id
 		self._register = register
-		self._archiver : Archiver = downloader.getArchiver(chapter_id)
+		self._archiver : Archiver = None
 		self._creation = _timestamp()
-		self.setStatus(DownloadState.CREATED)
+		self._status = DownloadState.CREATED
 		self._future = None
 		self._begin = None
 		self._end = None
 		self._cancelled = False
+		# Protects the transition from the resolver to the scheduler against cancellation
+		self._lock = threading.Lock()
 		with MutexLock(mutex) :
-			self._id = _generateId(self._creation, self._archiver.getFilename())
-			_active_downloads[self._id] = self
+			self._id = _generateId(self._creation, f"{downloader.getSite()}/{chapter_id}")
+			_addActive(self)
 	
-	def submit(self) -> str:
+	def submit(self, prefetch: Future = None) -> str:
 		self._creation = _timestamp() # Update the creation date to be the time of submission (just in case)
-		self.setStatus(DownloadState.QUEUED)
-		self._future = _executor.submit(self.perform)
-		self._future.add_done_callback(self.after)
+		self.setStatus(DownloadState.RESOLVING)
+		with self._lock :
+			# Otherwise a quick resolver could replace its future by the one of the scheduler before it is assigned
+			future = _resolver.submit(self.resolve, prefetch)
+			self._future = future
+		future.add_done_callback(self.afterResolve)
 		logger.info('Download %s submitted', self._id)
 		return self._id
 
+	def resolve(self, prefetch: Future = None) :
+		if prefetch is not None :
+			# Submitted to the resolver before this task, so it is either running or done
+			wait([prefetch])
+		try :
+			archiver = self._downloader.getArchiver(self._chapter)
+		except Exception :
+			logger.error('Error while resolving download %s:\n%s', self._id, traceback.format_exc())
+			with self._lock :
+				# A cancellation accepted in the meantime must be reported as such
+				self.setStatus(DownloadState.CANCELLED if self._cancelled else DownloadState.FAILED)
+			return
+		archiver.setProgressListener(self.onProgress)
+		with self._lock :
+			self._archiver = archiver
+			if self._cancelled :
+				self.setStatus(DownloadState.CANCELLED)
+				return
+			self.setStatus(DownloadState.QUEUED)
+			self._future = _scheduler.submit(self._downloader.getSite(), self.performAsync if aio.isEnabled() else self.perform)
+		self._future.add_done_callback(self.after)
+		logger.info('Download %s queued', self._id)
+
+	def afterResolve(self, future: Future) :
+		if future.cancelled() :
+			self.setStatus(DownloadState.CANCELLED)
+			logger.info('Download %s exited with status %s', self._id, str(self._status))
+
 	def perform(self) :
 		try :
 			self._begin = _timestamp()
@@ -109,25 +372,72 @@ class ChapterDownload :
 			logger.error('Error in download %s:\n%s', self._id, traceback.format_exc())
 			self.setStatus(DownloadState.FAILED)
 
+	async def performAsync(self) :
+		# Same as `perform` with the asyncio engine, the blocking steps being run in the executor of the event loop
+		loop = asyncio.get_running_loop()
+		try :
+			self._begin = _timestamp()
+			self.setStatus(DownloadState.PROCESSING)
+			logger.info('Download %s processing', self._id)
+			# Same as a `with` block, opening and closing the archive write to the disk
+			archiver = self.getArchiver()
+			await loop.run_in_executor(None, archiver.__enter__)
+			try :
+				await self._downloader.downloadChapterAsync(self._chapter, archiver)
+				await loop.run_in_executor(None, archiver.after)
+				self.setStatus(DownloadState.SAVING)
+			except BaseException as e :
+				await loop.run_in_executor(None, archiver.__exit__, type(e), e, e.__traceback__)
+				raise
+			await loop.run_in_executor(None, archiver.__exit__, None, None, None)
+			await loop.run_in_executor(None, self.setStatus, DownloadState.COMPLETE)
+		except Exception :
+			logger.error('Error in download %s:\n%s', self._id, traceback.format_exc())
+			await loop.run_in_executor(None, self.setStatus, DownloadState.FAILED)
+
 	def setStatus(self, status: DownloadState) :
 		if status.isFinal() :
 			self._end = _timestamp()
-			mutex.acquire()
 			self._status = status
-			if self._id in _active_downloads :
-				del _active_downloads[self._id]
-			else :
-				logger.warning('Download %s was already inactive', self._id)
-			_completed_downloads[self._id] = self.getState()
-			mutex.release()
+			state = self.getState()
+			with MutexLock(mutex) :
+				# Added to the completed downloads first, so that readers always find it in one of them
+				_completed_downloads[self._id] = state
+				if not _removeActive(self._id) :
+					logger.warning('Download %s was already inactive', self._id)
+				while len(_completed_downloads) > _history_maxlen :
+					_completed_downloads.popitem(last=False)
+			self._saveHistory(state)
 		else :
 			self._status = status
+			state = self.getState()
+		_publish('state', {'id': self._id, **state})
+
+	def _saveHistory(self, state: dict) :
+		try :
+			with getConnection(write=True) as con :
+				cur = con.cursor()
+				SqlDownloadEntry.save(cur, self._id, self._downloader.getSite(), self._chapter, state)
+				if _history_maxage > 0 :
+					SqlDownloadEntry.purge(cur, _timestamp() - _history_maxage * 1000)
+				con.commit()
+		except Exception :
+			logger.error('Could not save download %s in the history:\n%s', self._id, traceback.format_exc())
+
+	def onProgress(self, archiver: Archiver) :
+		_publish('progress', {
+			'id': self._id,
+			'completion': archiver.getProgress(),
+			'size': archiver.getRawSize()
+		})
 
-	def after(self, _=None) :
+	def after(self, future: Future = None) :
 		if not self._status.isFinal() :
-			self.setStatus(DownloadState.CANCELLED if self._cancelled else DownloadState.FAILED)
+			# The callbacks run inside `Future.cancel`, before `cancel` can set the flag
+			cancelled = self._cancelled or (future is not None and future.cancelled())
+			self.setStatus(DownloadState.CANCELLED if cancelled else DownloadState.FAILED)
 		if self._status == DownloadState.COMPLETE and self._register :
-			with getConnection() as con :
+			with getConnection(write=True) as con :
 				cur = con.cursor()
 				entry = SqlChapterEntry(self._downloader.getSite(), self._chapter, 
 						self._downloader, self._archiver.getFormatInfo()['manga_id'])
@@ -136,11 +446,12 @@ class ChapterDownload :
 		logger.info('Download %s exited with status %s', self._id, str(self._status))
 	
 	def getState(self) -> dict :
+		archiver = self._archiver
 		res = {
-			'file': self._archiver.getFilename(),
+			'file': archiver.getFilename() if archiver is not None else None,
 			'status': self._status.name,
-			'completion': self._archiver.getProgress(),
-			'size': self._archiver.getRawSize(),
+			'completion': archiver.getProgress() if archiver is not None else 0.0,
+			'size': archiver.getRawSize() if archiver is not None else 0,
 			'created': self._creation
 		}
 		if self._begin is not None :
@@ -150,50 +461,100 @@ class ChapterDownload :
 		return res
 	
 	def cancel(self) :
-		if self._cancelled :
-			return False
-		logger.info('Attempt to cancel download %s', self._id)
-		self._cancelled = self._future.cancel()
-		return self._cancelled
+		with self._lock :
+			if self._cancelled or self._status.isFinal() :
+				return False
+			logger.info('Attempt to cancel download %s', self._id)
+			if self._status == DownloadState.RESOLVING :
+				# If the metadata is being retrieved, the download is cancelled once this is done
+				self._future.cancel()
+				self._cancelled = True
+			else :
+				self._cancelled = self._future.cancel()
+			return self._cancelled
 
 	def getArchiver(self) -> Archiver :
 		return self._archiver
 
 
 def clearHistory() -> int :
-	mutex.acquire()
-	res = len(_completed_downloads)
-	_completed_downloads.clear()
-	mutex.release()
+	with MutexLock(mutex) :
+		_completed_downloads.clear()
+	with getConnection(write=True) as con :
+		res = SqlDownloadEntry.clear(con.cursor())
+		con.commit()
+	return res
+
+def _getStates(download_ids: "list[str]") -> "dict[str,dict]" :
+	"""
+	Retrieves the states of downloads from the memory or from the history in the database, None if not found
+	"""
+	active = _active_downloads
+	res = {}
+	for dl_id in download_ids :
+		if dl_id in active :
+			res[dl_id] = active[dl_id].getState()
+		else :
+			res[dl_id] = _completed_downloads.get(dl_id)
+	missing = [dl_id for dl_id, state in res.items() if state is None]
+	if len(missing) > 0 :
+		with getConnection() as con :
+			cur = con.cursor()
+			for dl_id in missing :
+				res[dl_id] = SqlDownloadEntry.get(cur, dl_id)
 	return res
 
 def getDownloadState(download_id: str, best_effort=False) :
-	with MutexLock(None if best_effort else mutex) :
-		if download_id in _active_downloads :
-			return _active_downloads[download_id].getState()
-		if download_id in _completed_downloads :
-			return _completed_downloads[download_id]
-		if best_effort :
-			return None
-	raise ApiNotFoundError(f"No download registered with the id {download_id}")
+	res = _getStates([download_id])[download_id]
+	if res is None and not best_effort :
+		raise ApiNotFoundError(f"No download registered with the id {download_id}")
+	return res
 
-def getAllDownloadStates(download_ids: "list[str]" = None) :
-	with MutexLock(mutex) :
-		if download_ids is not None :
-			return {dl_id: getDownloadState(dl_id, True) for dl_id in download_ids}
-		return {
-			**{dl_id: cdl.getState() for dl_id, cdl in _active_downloads.items()},
-			**_completed_downloads
-		}
+def getAllDownloadStates(download_ids: "list[str]") :
+	return _getStates(download_ids)
+
+def listDownloadStates(limit: int, site: str = None, statuses: "list[str]" = None, 
+		since: int = None, until: int = None, cursor: str = None) -> "tuple[dict[str,dict],str]" :
+	"""
+	Lists the states of the downloads from the most recently created, along with the cursor
+	to retrieve the next page (or None if this is the last one)
+	"""
+	position = None
+	if cursor is not None :
+		created, _, dl_id = cursor.partition('.')
+		if not created.isdigit() or len(dl_id) == 0 :
+			raise ApiFormatError(f"Invalid cursor {cursor}")
+		position = (int(created), dl_id)
+	active = [(dl_id, cdl.getState()) for dl_id, cdl in _active_downloads.items() 
+			if site is None or cdl._downloader.getSite() == site]
+	active = [
+		(dl_id, state) for dl_id, state in active 
+		if (statuses is None or state['status'] in statuses) 
+			and (since is None or state['created'] >= since) 
+			and (until is None or state['created'] < until) 
+			and (position is None or (state['created'], dl_id) < position)
+	]
+	with getConnection() as con :
+		history = SqlDownloadEntry.getPage(con.cursor(), limit, site, statuses, since, until, position)
+	# A download may have ended between the two reads, the stored state is the most recent
+	states = {dl_id: state for dl_id, state in active}
+	states.update(history)
+	page = sorted(states.items(), key=lambda e : (e[1]['created'], e[0]), reverse=True)[:limit]
+	next_cursor = None
+	if len(page) == limit :
+		next_cursor = f"{page[-1][1]['created']}.{page[-1][0]}"
+	return dict(page), next_cursor
+
+def getActiveDownloadStates() :
+	return {dl_id: cdl.getState() for dl_id, cdl in _active_downloads.items()}
 
 def cancelDownload(download_id: str, best_effort=False) -> bool :
-	with MutexLock(None if best_effort else mutex) :
-		if download_id in _active_downloads :
-			return _active_downloads[download_id].cancel()
-		if best_effort or download_id in _completed_downloads :
-			return False
+	download = _active_downloads.get(download_id)
+	if download is not None :
+		return download.cancel()
+	if best_effort or getDownloadState(download_id, True) is not None :
+		return False
 	raise ApiNotFoundError(f"No download registered with the id {download_id}")
 	
 def cancelDownloads(download_ids: "list[str]") -> "dict[str,bool]" :
-	with MutexLock(mutex) :
-		return {dl_id: cancelDownload(dl_id, True) for dl_id in download_ids}
+	return {dl_id: cancelDownload(dl_id, True) for dl_id in download_ids}
@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of the registry of downloads, not collected with the tests.
+Run it from the api folder with `python -m pytest -s tests/bench_downloads.py`
+
+It measures the latency of the readers of the registry with 1,000 active downloads
+and 50,000 completed ones, without and with a thread completing downloads continuously,
+then the cost of completing a download while threads poll the active downloads
+"""
+from nagato.utils import threads
+from nagato.utils.database import getConnection, SqlDownloadEntry
+
+import time
+import threading
+import statistics
+
+
+SITE = 'bench-downloads'
+NB_ACTIVE = 1000
+NB_COMPLETED = 50000
+NB_RUNS = 200
+
+
+class BenchDownloader :
+
+	def getSite(self) :
+		return SITE
+
+
+class BenchDownload(threads.ChapterDownload) :
+
+	def _saveHistory(self, state) :
+		# Only the registry is measured, not the database
+		pass
+
+
+def measure(name, f, n=NB_RUNS) :
+	times = []
+	for _ in range(n) :
+		begin = time.perf_counter()
+		f()
+		times.append((time.perf_counter() - begin) * 1000)
+	times.sort()
+	print(f"{name}: median {statistics.median(times):.3f} ms, p99 {times[int(n * 0.99) - 1]:.3f} ms")
+
+
+def test_registry_latency() :
+	dl = BenchDownloader()
+	now = threads._timestamp()
+	with getConnection(write=True) as con :
+		cur = con.cursor()
+		for i in range(NB_COMPLETED) :
+			SqlDownloadEntry.save(cur, f"done{i:05d}", SITE, f"c{i}", {
+				'file': 'chapter.cbz', 'status': 'COMPLETE', 'completion': 1.0, 'size': 1,
+				'created': now - NB_COMPLETED + i, 'begin': now, 'end': now
+			})
+		con.commit()
+	active = [BenchDownload(dl, f"a{i}") for i in range(NB_ACTIVE)]
+	ids = [a._id for a in active[:50]] + [f"done{i:05d}" for i in range(NB_COMPLETED - 50, NB_COMPLETED)]
+	stop = threading.Event()
+	def complete() :
+		i = 0
+		while not stop.is_set() :
+			BenchDownload(dl, f"x{i}").setStatus(threads.DownloadState.COMPLETE)
+			i += 1
+	def poll() :
+		while not stop.is_set() :
+			threads.getActiveDownloadStates()
+	readers = []
+	try :
+		print()
+		for label in ('idle', 'with concurrent completions') :
+			if label != 'idle' :
+				completer = threading.Thread(target=complete)
+				completer.start()
+			measure(f"[{label}] active states ({NB_ACTIVE})", threads.getActiveDownloadStates)
+			measure(f"[{label}] states by ids (100)", lambda : threads.getAllDownloadStates(ids))
+			measure(f"[{label}] first page (100)", lambda : threads.listDownloadStates(100))
+			measure(f"[{label}] filtered page (100)", lambda : threads.listDownloadStates(100, SITE, ['COMPLETE'],
+					now - NB_COMPLETED, None, f"{now - NB_COMPLETED // 2}.done99999"))
+		stop.set()
+		completer.join()
+		stop.clear()
+		readers = [threading.Thread(target=poll) for _ in range(4)]
+		for reader in readers :
+			reader.start()
+		downloads = [BenchDownload(dl, f"y{i}") for i in range(2000)]
+		measure('completion under 4 polling readers',
+				lambda : downloads.pop().setStatus(threads.DownloadState.COMPLETE), len(downloads))
+	finally :
+		stop.set()
+		for reader in readers :
+			reader.join()
+		for download in active :
+			download.setStatus(threads.DownloadState.CANCELLED)
+		with getConnection(write=True) as con :
+			con.cursor().execute("DELETE FROM downloads WHERE site=?", [SITE])
+			con.commit()
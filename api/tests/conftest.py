@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+# The configuration is read when the modules of the API are imported, so it must exist before.
+# Without one, a throwaway configuration is created and removed once the tests are over
+API_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CONF_DIR = os.path.join(API_DIR, 'config')
+
+sys.path.insert(0, API_DIR)
+
+_tmp_dir = None
+
+if not os.path.exists(CONF_DIR) :
+	_tmp_dir = tempfile.mkdtemp(prefix='nagato-tests-')
+	with open(os.path.join(API_DIR, 'default-config', 'conf.json'), 'r') as f :
+		conf = json.load(f)
+	conf['global']['chapters.destination'] = os.path.join(_tmp_dir, 'data')
+	conf['api']['database.path'] = os.path.join(_tmp_dir, 'nagato.db')
+	conf['api']['requests.cache.path'] = os.path.join(_tmp_dir, 'cache.db')
+	conf['api']['covers.path'] = os.path.join(_tmp_dir, 'covers')
+	os.mkdir(CONF_DIR)
+	with open(os.path.join(CONF_DIR, 'conf.json'), 'w') as f :
+		json.dump(conf, f, indent='\t')
+	shutil.copy(os.path.join(API_DIR, 'default-config', 'env.json'), os.path.join(CONF_DIR, 'env.json'))
+
+
+def pytest_unconfigure(config) :
+	if _tmp_dir is not None :
+		shutil.rmtree(CONF_DIR, ignore_errors=True)
+		shutil.rmtree(_tmp_dir, ignore_errors=True)
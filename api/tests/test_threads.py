@@ -0,0 +1,121 @@
+from nagato.utils import threads
+
+import time
+import asyncio
+import threading
+
+
+class FakeArchiver :
+
+	def setProgressListener(self, listener) :
+		pass
+
+	def getFilename(self) :
+		return 'chapter.cbz'
+
+	def getProgress(self) :
+		return 0.0
+
+	def getRawSize(self) :
+		return 0
+
+	def after(self) :
+		pass
+
+	def __enter__(self) :
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb) :
+		return False
+
+
+class BlockingDownloader :
+	"""
+	Downloader whose chapters are only downloaded once `release` is set,
+	so that the following downloads of its site stay queued
+	"""
+
+	def __init__(self, site) :
+		self._site = site
+		self.release = threading.Event()
+
+	def getSite(self) :
+		return self._site
+
+	def getArchiver(self, chapter_id) :
+		return FakeArchiver()
+
+	def downloadChapter(self, chapter_id, archiver) :
+		self.release.wait(10)
+
+	async def downloadChapterAsync(self, chapter_id, archiver) :
+		while not self.release.is_set() :
+			await asyncio.sleep(0.01)
+
+
+def waitForStatus(download_id, statuses, timeout=10) :
+	end = time.monotonic() + timeout
+	while time.monotonic() < end :
+		status = threads.getDownloadState(download_id)['status']
+		if status in statuses :
+			return status
+		time.sleep(0.01)
+	return threads.getDownloadState(download_id)['status']
+
+
+def waitForQueue(download_ids, timeout=10) :
+	"""
+	Waits for one of the downloads to be processed while the other is queued,
+	the downloads being resolved concurrently they may reach the scheduler in any order
+	"""
+	end = time.monotonic() + timeout
+	while time.monotonic() < end :
+		states = threads.getAllDownloadStates(download_ids)
+		running = [dl_id for dl_id in download_ids if states[dl_id]['status'] == 'PROCESSING']
+		queued = [dl_id for dl_id in download_ids if states[dl_id]['status'] == 'QUEUED']
+		if len(running) == 1 and len(queued) == 1 :
+			return running[0], queued[0]
+		time.sleep(0.01)
+	raise AssertionError(f"Downloads were not queued behind each other: {threads.getAllDownloadStates(download_ids)}")
+
+
+def test_cancel_queued_download() :
+	dl = BlockingDownloader('test-cancel-queued')
+	threads.setSiteLimit(dl.getSite(), 1)
+	download_ids = [threads.ChapterDownload(dl, chapter_id).submit() for chapter_id in ('c1', 'c2')]
+	try :
+		running, queued = waitForQueue(download_ids)
+		assert threads.cancelDownload(queued)
+		assert threads.getDownloadState(queued)['status'] == 'CANCELLED'
+	finally :
+		dl.release.set()
+	assert waitForStatus(running, ['COMPLETE', 'FAILED']) == 'COMPLETE'
+	assert threads.getDownloadState(queued)['status'] == 'CANCELLED'
+
+
+class FailingDownloader(BlockingDownloader) :
+	"""
+	Downloader whose chapters can't be resolved, failing once `release` is set.
+	`resolving` is set once the resolution started, so that it can no longer be cancelled before it runs
+	"""
+
+	def __init__(self, site) :
+		super().__init__(site)
+		self.resolving = threading.Event()
+
+	def getArchiver(self, chapter_id) :
+		self.resolving.set()
+		self.release.wait(10)
+		raise RuntimeError(f"Chapter {chapter_id} can't be resolved")
+
+
+def test_cancel_failing_resolution() :
+	dl = FailingDownloader('test-cancel-failing')
+	download_id = threads.ChapterDownload(dl, 'c1').submit()
+	try :
+		assert dl.resolving.wait(10)
+		assert threads.cancelDownload(download_id)
+	finally :
+		dl.release.set()
+	assert waitForStatus(download_id, ['CANCELLED', 'FAILED']) == 'CANCELLED'
+	assert not threads.cancelDownload(download_id)